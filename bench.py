@@ -0,0 +1,466 @@
+"""
+Benchmarks for the todo bot.
+
+    python bench.py handlers --users 100 --tasks 1000 --ops 2000
+    python bench.py handlers --storage memory://
+    python bench.py parser --length 4096
+    python bench.py export --rows 50000
+    python bench.py export-latency --rows 20000 --exports 4
+    python bench.py import --rows 50000
+
+`handlers` seeds a database and drives the command handlers in tbot.py
+through stub Update/Context objects, without touching the network. Export
+measurements run in a fresh subprocess so peak RSS figures are not polluted
+by earlier runs. Results are printed and appended to bench_output.txt so they
+can be compared across commits.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import re
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+import cache
+import export
+import fakes
+import importer
+import repository
+import storage
+import tbot
+
+OUTPUT = "bench_output.txt"
+
+# Seeded task descriptions are drawn from these, so a task= search for one of
+# them matches a realistic fraction of a user's tasks.
+WORDS = (
+    "buy call email write review fix plan book pay clean send read prepare check order update meet visit "
+    "report invoice milk car dentist garden taxes slides budget flight hotel laptop printer kitchen"
+).split()
+
+# 2024-01-01 10:00:00 UTC
+CREATED_AT = 1704103200
+
+
+def rss_mb() -> float:
+    """Current resident set size of this process, in MiB."""
+    with open("/proc/self/statm") as f:
+        pages = int(f.read().split()[1])
+    return pages * os.sysconf("SC_PAGE_SIZE") / 2**20
+
+
+def peak_rss_mb() -> float:
+    # ru_maxrss is reported in KiB on Linux.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def seed_rows(users: int, tasks_per_user: int):
+    """(user_id, importer.IMPORT_COLUMNS tuple) of every seeded task, users one after the other."""
+    rng = random.Random(0)
+    for user_id in range(1, users + 1):
+        for i in range(tasks_per_user):
+            yield user_id, (
+                f"{' '.join(rng.sample(WORDS, 4))} item {i} with a reasonably long description",
+                "Alice" if i % 2 else "Bob",
+                f"category {i % 7}",
+                f"tag{i % 5},tag{i % 11}",
+                CREATED_AT,
+                None,
+                CREATED_AT + 86400 if i % 3 == 0 else None,
+            )
+
+
+async def seed(path: str, users: int, tasks_per_user: int):
+    """Seed the SQLite database at path the way seed_repository() seeds any backend."""
+    repo = repository.SqliteRepository(path, readers=1)
+    await repo.open()
+    try:
+        await seed_repository(repo, users, tasks_per_user)
+    finally:
+        await repo.close()
+
+
+async def seed_repository(repo, users: int, tasks_per_user: int):
+    """
+    Add the seeded tasks through repo.import_tasks(), so tags, full-text
+    entries and /stats counts are filled as an /import fills them.
+    """
+    by_user = {}
+    for user_id, row in seed_rows(users, tasks_per_user):
+        by_user.setdefault(user_id, []).append(row)
+    for user_id, rows in by_user.items():
+        await repo.import_tasks(user_id, rows)
+
+
+async def legacy_xlsx(user_id: int):
+    """The pre-streaming /download: fetchall() into a regular Workbook saved to a temp file."""
+    from openpyxl import Workbook
+
+    rows = await storage.fetch_all_tasks(user_id)
+    wb = Workbook()
+    ws = wb.active
+    ws.append(export.HEADERS)
+    for row in rows:
+        ws.append(row)
+    with tempfile.NamedTemporaryFile(delete=False, suffix=".xlsx") as tmp:
+        filename = tmp.name
+        wb.save(filename)
+    with open(filename, "rb") as f:
+        size = len(f.read())
+    os.remove(filename)
+    return size
+
+
+def streaming(fmt: str):
+    async def run(user_id: int):
+        data, _ = export.export_tasks(storage.get_pool().path, user_id, fmt)
+        return len(data)
+
+    return run
+
+
+EXPORT_MODES = {
+    "legacy": legacy_xlsx,
+    **{fmt: streaming(fmt) for fmt in export.FORMATS},
+}
+
+
+async def export_worker(path: str, mode: str):
+    await storage.open_pool(path, readers=1)
+    rss_before = rss_mb()
+    start = time.perf_counter()
+    size = await EXPORT_MODES[mode](1)
+    elapsed = time.perf_counter() - start
+    await storage.close_pool()
+    print(
+        json.dumps(
+            {
+                "mode": mode,
+                "seconds": round(elapsed, 3),
+                "file_kb": size // 1024,
+                "peak_rss_mb": round(peak_rss_mb(), 1),
+                "rss_growth_mb": round(peak_rss_mb() - rss_before, 1),
+            }
+        )
+    )
+
+
+def run_export(args) -> list:
+    lines = [f"export: {args.rows} rows"]
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, "tasks.db")
+        asyncio.run(seed(path, 1, args.rows))
+        for mode in EXPORT_MODES:
+            out = subprocess.run(
+                [sys.executable, __file__, "export-worker", path, mode],
+                check=True,
+                capture_output=True,
+                text=True,
+            ).stdout
+            result = json.loads(out.strip().splitlines()[-1])
+            lines.append(
+                f"  {result['mode']:<10} {result['seconds']:>8.3f}s  file {result['file_kb']:>7} KiB  "
+                f"peak RSS {result['peak_rss_mb']:>7.1f} MiB  (+{result['rss_growth_mb']:.1f} MiB)"
+            )
+    return lines
+
+
+async def import_round_trip(path: str, fmt: str) -> tuple:
+    """Export user 1's tasks in fmt and import them for user 2. Returns (parse seconds, insert seconds)."""
+    await storage.open_pool(path, readers=1)
+    data, _ = export.export_tasks(path, 1, fmt)
+    start = time.perf_counter()
+    tasks, _, _ = importer.parse_file(data, fmt, CREATED_AT)
+    parsed = time.perf_counter()
+    await storage.import_tasks(2, tasks)
+    inserted = time.perf_counter()
+    async with storage.get_pool().writer() as conn:
+        await conn.execute("DELETE FROM tasks WHERE user_id=2")
+    await storage.close_pool()
+    return parsed - start, inserted - parsed
+
+
+def run_import(args) -> list:
+    lines = [f"import: {args.rows} rows"]
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, "tasks.db")
+        asyncio.run(seed(path, 1, args.rows))
+        for fmt in importer.FORMATS:
+            parse, insert = asyncio.run(import_round_trip(path, fmt))
+            lines.append(f"  {fmt:<10} parse {parse:>7.3f}s  insert {insert:>7.3f}s  ({args.rows / (parse + insert):,.0f} rows/s)")
+    return lines
+
+
+def percentile(values: list, pct: float) -> float:
+    values = sorted(values)
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+async def command_latency_during_exports(path: str, exports: int, mode: str) -> list:
+    """Time /list queries for user 2 while user 1's exports are being built."""
+    await storage.open_pool(path, readers=2)
+    pool = export.ExportPool(workers=exports, queue_size=0)
+    if mode == "process":
+        pool.start()
+        # Pay the worker start-up cost before measuring.
+        await asyncio.gather(*(pool.run(export.export_tasks, path, 0) for _ in range(exports)))
+
+    async def build():
+        if mode == "event-loop":
+            export.export_tasks(path, 1)
+        else:
+            await pool.run(export.export_tasks, path, 1)
+
+    jobs = asyncio.gather(*(build() for _ in range(exports)))
+    latencies = []
+    while not jobs.done():
+        start = time.perf_counter()
+        await storage.fetch_task_page(2, {})
+        latencies.append((time.perf_counter() - start) * 1000)
+        await asyncio.sleep(0.005)
+    await jobs
+    pool.shutdown()
+    await storage.close_pool()
+    return latencies
+
+
+def run_export_latency(args) -> list:
+    lines = [f"export-latency: {args.exports} concurrent exports of {args.rows} rows, /list latency of another user"]
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, "tasks.db")
+        asyncio.run(seed(path, 2, args.rows))
+        for mode in ["event-loop", "thread", "process"]:
+            latencies = asyncio.run(command_latency_during_exports(path, args.exports, mode))
+            lines.append(
+                f"  {mode:<10} samples {len(latencies):>5}  p50 {percentile(latencies, 50):>8.2f} ms  "
+                f"p99 {percentile(latencies, 99):>8.2f} ms"
+            )
+    return lines
+
+
+# ---------------- Handler benchmarks ----------------
+
+
+def handler_workloads(users: int, tasks: int, rng: random.Random) -> dict:
+    """handler name -> function returning (handler, update, context) for one call."""
+
+    def user():
+        return rng.randint(1, users)
+
+    def task_id(user_id):
+        # seed() inserts users' tasks one after the other, so ids are predictable.
+        return (user_id - 1) * tasks + rng.randint(1, tasks)
+
+    def add():
+        return (tbot.add, *fakes.command(user(), f"/add Benchmark task {rng.random()} who=Carol tags=bench,tag{rng.randint(0, 9)}"))
+
+    def list_open():
+        return (tbot.list_tasks, *fakes.command(user(), "/list"))
+
+    def list_search():
+        return (tbot.list_tasks, *fakes.command(user(), f"/list task={rng.choice(WORDS)}"))
+
+    def list_tags():
+        return (tbot.list_tasks, *fakes.command(user(), f"/list tags=tag{rng.randint(0, 4)},tag{rng.randint(0, 10)}"))
+
+    def done():
+        u = user()
+        return (tbot.done, *fakes.command(u, f"/done {task_id(u)}"))
+
+    def update():
+        u = user()
+        return (tbot.update_task, *fakes.command(u, f"/update {task_id(u)} Renamed task who=Dave"))
+
+    def download():
+        return (tbot.download, *fakes.command(user(), "/download format=csv"))
+
+    return {
+        "add": add,
+        "list": list_open,
+        "list task=": list_search,
+        "list tags=": list_tags,
+        "done": done,
+        "update": update,
+        "download csv": download,
+    }
+
+
+async def run_workload(make_call, ops: int, concurrency: int):
+    latencies = []
+    remaining = iter(range(ops))
+
+    async def worker():
+        for _ in remaining:
+            handler, update, context = make_call()
+            start = time.perf_counter()
+            await handler(update, context)
+            latencies.append((time.perf_counter() - start) * 1000)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return latencies, time.perf_counter() - start
+
+
+async def bench_handlers(path: str, args) -> list:
+    if args.storage == "sqlite":
+        repo = repository.SqliteRepository(path)
+    else:
+        repo = repository.from_url(args.storage)
+    saved = repository.current()
+    repository.use(repo)
+    rng = random.Random(args.seed)
+    lines = []
+    await repo.open()
+    try:
+        if args.storage != "sqlite":
+            start = time.perf_counter()
+            await seed_repository(repo, args.users, args.tasks)
+            lines.append(f"  seeded in {time.perf_counter() - start:.2f}s")
+        for name, make_call in handler_workloads(args.users, args.tasks, rng).items():
+            ops = args.ops // 10 if name.startswith("download") else args.ops
+            latencies, elapsed = await run_workload(make_call, ops, args.concurrency)
+            lines.append(
+                f"  {name:<14} {ops:>6} ops  {ops / elapsed:>9.1f} ops/s  p50 {percentile(latencies, 50):>7.2f} ms  "
+                f"p99 {percentile(latencies, 99):>7.2f} ms  peak RSS {peak_rss_mb():>6.1f} MiB"
+            )
+    finally:
+        # Open database connections keep the process alive; a failing handler
+        # must not leave the run hanging.
+        await repo.close()
+        repository.use(saved)
+    stats = cache.pages.stats()
+    lines.append(
+        f"  page cache: {stats['hits']} hits, {stats['misses']} misses, {stats['entries']} entries, "
+        f"{stats['bytes'] // 1024} KiB"
+    )
+    return lines
+
+
+def run_handlers(args) -> list:
+    lines = [
+        f"handlers: {args.users} users x {args.tasks} tasks, {args.ops} ops per handler, "
+        f"concurrency {args.concurrency}, storage {args.storage}"
+    ]
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = args.db or os.path.join(tmpdir, "tasks.db")
+        if args.storage == "sqlite":
+            start = time.perf_counter()
+            asyncio.run(seed(path, args.users, args.tasks))
+            lines.append(f"  seeded in {time.perf_counter() - start:.2f}s")
+        lines.extend(asyncio.run(bench_handlers(path, args)))
+    return lines
+
+
+# ---------------- Parser micro-benchmark ----------------
+
+
+def legacy_parse_params(text: str):
+    """parse_params as it was before the single-pass tokenizer."""
+    pattern = r"(task|who|category|tags|show_completed|format)\s*=\s*(.*?)(?=\s+\w+\s*=|$)"
+    return {k.lower(): v.strip() for k, v in re.findall(pattern, text)}
+
+
+def legacy_parse_add_command(text: str):
+    match = re.search(r"\b(who|category|tags)\s*=", text)
+    if match:
+        return text[: match.start()].strip(), legacy_parse_params(text[match.start() :].strip())
+    return text.strip(), {}
+
+
+def parser_inputs(length: int) -> dict:
+    return {
+        "typical": "Buy milk, eggs, bread who=Alice category=Home tags=grocery,food",
+        "long value": "Write " + "word " * (length // 5) + "who=Bob tags=a,b",
+        "whitespace run": "task=a" + " " * length + "x",
+        "many equals": "who=" + "a=" * (length // 2),
+        "many keys": " ".join(f"who{i % 10}=v" for i in range(length // 7)),
+    }
+
+
+def run_parser(args) -> list:
+    lines = [f"parser: inputs up to {args.length} chars, best of {args.repeat}"]
+    implementations = {
+        "legacy": (legacy_parse_params, legacy_parse_add_command),
+        "tokenizer": (tbot.parse_params, tbot.parse_add_command),
+    }
+    for name, text in parser_inputs(args.length).items():
+        cells = []
+        for impl, (parse_params, parse_add_command) in implementations.items():
+            best = float("inf")
+            for _ in range(args.repeat):
+                start = time.perf_counter()
+                parse_params(text)
+                parse_add_command(text)
+                best = min(best, time.perf_counter() - start)
+            cells.append(f"{impl} {best * 1000:>9.3f} ms")
+        lines.append(f"  {name:<15} " + "  ".join(cells))
+    return lines
+
+
+def report(lines: list):
+    text = "\n".join(lines)
+    print(text)
+    with open(OUTPUT, "a") as f:
+        f.write(f"# {datetime.now():%Y-%m-%d %H:%M:%S}\n{text}\n\n")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("handlers", help="throughput and latency of the command handlers")
+    p.add_argument("--users", type=int, default=100)
+    p.add_argument("--tasks", type=int, default=1000, help="tasks seeded per user")
+    p.add_argument("--ops", type=int, default=2000, help="calls per handler")
+    p.add_argument("--concurrency", type=int, default=8)
+    p.add_argument("--seed", type=int, default=0)
+    p.add_argument("--db", help="seed this database file instead of a temporary one")
+    p.add_argument(
+        "--storage",
+        default="sqlite",
+        help='"sqlite" (the default), "memory://", or a repository.from_url() URL such as "tortoise+sqlite://:memory:"',
+    )
+
+    p = sub.add_parser("parser", help="command parser against adversarial inputs")
+    p.add_argument("--length", type=int, default=4096, help="Telegram caps messages at 4096 characters")
+    p.add_argument("--repeat", type=int, default=5)
+
+    p = sub.add_parser("export", help="peak memory and time of /download")
+    p.add_argument("--rows", type=int, default=50000)
+
+    p = sub.add_parser("export-latency", help="/list latency while exports are being built")
+    p.add_argument("--rows", type=int, default=20000)
+    p.add_argument("--exports", type=int, default=2)
+
+    p = sub.add_parser("import", help="time to parse and insert an /import file")
+    p.add_argument("--rows", type=int, default=50000)
+
+    p = sub.add_parser("export-worker")
+    p.add_argument("path")
+    p.add_argument("mode", choices=EXPORT_MODES)
+
+    args = parser.parse_args()
+    if args.command == "handlers":
+        report(run_handlers(args))
+    elif args.command == "parser":
+        report(run_parser(args))
+    elif args.command == "export":
+        report(run_export(args))
+    elif args.command == "export-latency":
+        report(run_export_latency(args))
+    elif args.command == "import":
+        report(run_import(args))
+    elif args.command == "export-worker":
+        asyncio.run(export_worker(args.path, args.mode))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+"""
+In-memory cache of rendered /list pages.
+
+Entries are grouped per user and evicted least-recently-used first once the
+cache holds more than its byte budget. Every write to a user's tasks goes
+through storage, which drops that user's entries after committing, so a
+cached page is never older than the user's last change.
+"""
+from collections import OrderedDict
+
+MAX_BYTES = 8 * 1024 * 1024
+# Rough per-entry bookkeeping cost on top of the rendered text.
+ENTRY_OVERHEAD = 512
+
+
+class PageCache:
+    def __init__(self, max_bytes: int = MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self._entries = OrderedDict()  # (user_id, key) -> (value, size)
+        self._user_keys = {}  # user_id -> set of keys cached for that user
+        self._generations = {}  # user_id -> number of invalidations so far
+
+    def generation(self, user_id: int) -> int:
+        """
+        Token to pass to put(). Take it before reading from the database, so a
+        page rendered from data that changed in the meantime is not cached.
+        """
+        return self._generations.get(user_id, 0)
+
+    def get(self, user_id: int, key):
+        entry = self._entries.get((user_id, key))
+        if entry is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end((user_id, key))
+        self.hits += 1
+        return entry[0]
+
+    def put(self, user_id: int, key, value, size: int, generation: int):
+        if generation != self.generation(user_id):
+            return
+        size += ENTRY_OVERHEAD
+        if size > self.max_bytes:
+            return
+        self._discard(user_id, key)
+        self._entries[(user_id, key)] = (value, size)
+        self._user_keys.setdefault(user_id, set()).add(key)
+        self.size += size
+        while self.size > self.max_bytes:
+            (old_user, old_key), _ = next(iter(self._entries.items()))
+            self._discard(old_user, old_key)
+            self.evictions += 1
+
+    def invalidate(self, user_id: int):
+        """Forget everything cached for user_id."""
+        self._generations[user_id] = self.generation(user_id) + 1
+        for key in list(self._user_keys.get(user_id, ())):
+            self._discard(user_id, key)
+        self.invalidations += 1
+
+    def clear(self):
+        for user_id in list(self._user_keys):
+            self.invalidate(user_id)
+
+    def _discard(self, user_id: int, key):
+        entry = self._entries.pop((user_id, key), None)
+        if entry is None:
+            return
+        self.size -= entry[1]
+        keys = self._user_keys[user_id]
+        keys.discard(key)
+        if not keys:
+            del self._user_keys[user_id]
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self._entries),
+            "bytes": self.size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+        }
+
+
+pages = PageCache()
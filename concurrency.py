@@ -0,0 +1,82 @@
+"""
+Concurrent update processing that keeps each user's updates in order.
+
+python-telegram-bot processes updates one at a time by default, so one slow
+handler (a big /download, say) holds up every other user. Processing them
+concurrently fixes that, but then a user's /add and the /done right after it
+could run in either order. PerUserUpdateProcessor runs updates of different
+users concurrently while chaining those of the same user one after the other.
+"""
+import asyncio
+
+from telegram.ext import BaseUpdateProcessor
+
+DEFAULT_CONCURRENCY = 8
+# Updates admitted at once, counting those waiting for an earlier update of
+# the same user; further updates wait in the Application's update queue.
+DEFAULT_MAX_PENDING = 256
+
+
+def update_key(update):
+    """The user an update belongs to, or None if it doesn't need ordering."""
+    user = getattr(update, "effective_user", None)
+    if user is not None:
+        return user.id
+    chat = getattr(update, "effective_chat", None)
+    if chat is not None:
+        return ("chat", chat.id)
+    return None
+
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """
+    Runs up to `max_concurrent_updates` handlers at once, starting updates of
+    the same user strictly in arrival order and only after the previous one
+    finished.
+
+    The Application hands updates over in arrival order, and each is linked
+    behind its user's previous update before the first await, so ordering
+    holds regardless of how long each handler takes.
+    """
+
+    def __init__(self, max_concurrent_updates: int = DEFAULT_CONCURRENCY, max_pending_updates: int = None):
+        if max_concurrent_updates < 1:
+            raise ValueError("max_concurrent_updates must be a positive integer")
+        # The base class semaphore bounds the updates admitted; ours bounds the
+        # handlers actually running. Waiting for a user's earlier update thus
+        # never takes a running slot away from other users.
+        super().__init__(max(max_pending_updates or DEFAULT_MAX_PENDING, max_concurrent_updates))
+        self.concurrency = max_concurrent_updates
+        self._running = asyncio.Semaphore(max_concurrent_updates)
+        self._tails = {}  # key -> future resolved when the key's latest update is done
+
+    async def do_process_update(self, update, coroutine):
+        key = update_key(update)
+        previous = self._tails.get(key) if key is not None else None
+        done = asyncio.get_running_loop().create_future()
+        if key is not None:
+            self._tails[key] = done
+        try:
+            if previous is not None:
+                # Shielded: being cancelled must not cancel the update before us.
+                await asyncio.shield(previous)
+            async with self._running:
+                await coroutine
+        finally:
+            if asyncio.iscoroutine(coroutine):
+                # Never awaited if we were cancelled while waiting our turn.
+                coroutine.close()
+            done.set_result(None)
+            if self._tails.get(key) is done:
+                del self._tails[key]
+
+    @property
+    def active_users(self) -> int:
+        """Users with an update being processed or waiting."""
+        return len(self._tails)
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
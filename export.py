@@ -0,0 +1,235 @@
+"""
+Builders for the files sent by /download.
+
+Exports are built in a small pool of worker processes that read the database
+themselves, so a large export neither blocks the event loop nor competes with
+it for the GIL. Rows are streamed into the file as they come off the cursor,
+so memory use does not grow with the number of tasks being exported.
+Backends other than SQLite stream their rows to a writer thread instead (see
+ExportPool.stream).
+"""
+import asyncio
+import csv
+import gzip
+import io
+import json
+import multiprocessing
+import queue
+import sqlite3
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+
+from openpyxl import Workbook
+
+import timeutil
+from storage import ALL_TASKS_QUERY, TASK_COLUMNS
+
+HEADERS = [
+    "ID",
+    "Task",
+    "Who",
+    "Category",
+    "Tags",
+    "Created At",
+    "Updated At",
+    "Completed At",
+]
+
+# Exports built at the same time, and how many more may wait for a free worker
+# before new requests are turned away.
+EXPORT_WORKERS = 2
+EXPORT_QUEUE_SIZE = 8
+# Rows handed at a time to the thread writing a streamed export (see
+# ExportPool.stream), and batches that may wait for it.
+STREAM_BATCH_SIZE = 1000
+STREAM_BATCHES = 2
+
+
+class ExportQueueFull(Exception):
+    pass
+
+
+def write_xlsx(rows, fileobj) -> int:
+    """Write the iterable of task rows as an XLSX file to fileobj. Returns the row count."""
+    # Write-only workbooks spool rows to disk as they are appended instead of
+    # keeping a cell object per value in memory.
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet("Tasks")
+    ws.append(HEADERS)
+
+    count = 0
+    for row in rows:
+        ws.append(row)
+        count += 1
+
+    wb.save(fileobj)
+    return count
+
+
+def write_csv(rows, fileobj) -> int:
+    """Write the iterable of task rows as UTF-8 CSV to the binary fileobj. Returns the row count."""
+    text = io.TextIOWrapper(fileobj, encoding="utf-8", newline="")
+    writer = csv.writer(text)
+    writer.writerow(HEADERS)
+    count = 0
+    for row in rows:
+        writer.writerow(row)
+        count += 1
+    text.flush()
+    # Hand fileobj back to the caller open.
+    text.detach()
+    return count
+
+
+def write_csv_gz(rows, fileobj) -> int:
+    with gzip.GzipFile(fileobj=fileobj, mode="wb") as gz:
+        return write_csv(rows, gz)
+
+
+def write_jsonl(rows, fileobj) -> int:
+    """Write one JSON object per task row, keyed by column name. Returns the row count."""
+    keys = TASK_COLUMNS.split(", ")
+    count = 0
+    for row in rows:
+        fileobj.write(json.dumps(dict(zip(keys, row)), ensure_ascii=False).encode("utf-8"))
+        fileobj.write(b"\n")
+        count += 1
+    return count
+
+
+# format= value of /download -> writer
+FORMATS = {
+    "xlsx": write_xlsx,
+    "csv": write_csv,
+    "csv.gz": write_csv_gz,
+    "jsonl": write_jsonl,
+}
+
+
+def localize_rows(rows, timezone: str):
+    """Yield task rows with their epoch timestamps turned into wall-clock text in timezone."""
+    fmt = timeutil.format_timestamp
+    for row in rows:
+        yield row[:5] + (fmt(row[5], timezone), fmt(row[6], timezone), fmt(row[7], timezone))
+
+
+def export_tasks(db_path: str, user_id: int, fmt: str = "xlsx", timezone: str = timeutil.DEFAULT_TIMEZONE):
+    """
+    Build the export of user_id's tasks in the given format straight from the
+    database file, with times shown in timezone. Runs inside an export worker.
+    Returns (file bytes, row count).
+    """
+    conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+    try:
+        return export_rows(conn.execute(ALL_TASKS_QUERY, (user_id,)), fmt, timezone)
+    finally:
+        conn.close()
+
+
+def export_rows(rows, fmt: str = "xlsx", timezone: str = timeutil.DEFAULT_TIMEZONE):
+    """
+    Build an export from an iterable of task rows (TASK_COLUMNS), written
+    into the file as they are taken from it. Returns (file bytes, row count).
+    """
+    buffer = io.BytesIO()
+    count = FORMATS[fmt](localize_rows(rows, timezone), buffer)
+    return buffer.getvalue(), count
+
+
+async def stream_rows(rows, fmt: str, timezone: str):
+    """
+    export_rows() over an async iterator of task rows. The file is written on
+    a thread while the rows are read, a batch at a time through a bounded
+    queue, so memory does not grow with the number of tasks.
+    """
+    loop = asyncio.get_running_loop()
+    batches = queue.Queue(maxsize=STREAM_BATCHES)
+    finished = threading.Event()
+
+    def build():
+        def consume():
+            while (batch := batches.get()) is not None:
+                yield from batch
+
+        try:
+            return export_rows(consume(), fmt, timezone)
+        finally:
+            finished.set()
+
+    def put(batch):
+        # Gives up once the writer has stopped, rather than waiting forever.
+        while not finished.is_set():
+            try:
+                batches.put(batch, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    building = loop.run_in_executor(None, build)
+    try:
+        batch = []
+        async for row in rows:
+            batch.append(row)
+            if len(batch) >= STREAM_BATCH_SIZE:
+                if finished.is_set():
+                    break
+                await loop.run_in_executor(None, put, batch)
+                batch = []
+        if batch:
+            await loop.run_in_executor(None, put, batch)
+    finally:
+        # Ends the file even when reading fails, so the writer does not hang.
+        await loop.run_in_executor(None, put, None)
+    return await building
+
+
+class ExportPool:
+    """
+    Bounded pool of worker processes building exports. Up to `workers` exports
+    run at once and up to `queue_size` more wait their turn; beyond that run()
+    raises ExportQueueFull. Until start() is called jobs run on the default
+    thread pool instead, which is enough for tests and benchmarks.
+    """
+
+    def __init__(self, workers: int = EXPORT_WORKERS, queue_size: int = EXPORT_QUEUE_SIZE):
+        self.workers = workers
+        self.queue_size = queue_size
+        self.pending = 0
+        self._executor = None
+
+    def start(self):
+        # Workers are spawned rather than forked: the bot process runs
+        # aiosqlite threads, which must not be copied into a child mid-flight.
+        self._executor = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context("spawn"))
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(cancel_futures=True)
+            self._executor = None
+
+    @contextmanager
+    def _admit(self):
+        if self.pending >= self.workers + self.queue_size:
+            raise ExportQueueFull()
+        self.pending += 1
+        try:
+            yield
+        finally:
+            self.pending -= 1
+
+    async def run(self, fn, *args):
+        with self._admit():
+            return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+
+    async def stream(self, rows, fmt: str = "xlsx", timezone: str = timeutil.DEFAULT_TIMEZONE):
+        """
+        Build an export from an async iterator of task rows, for storage
+        backends the workers cannot read themselves. Counts against the same
+        limit as run(). Returns (file bytes, row count).
+        """
+        with self._admit():
+            return await stream_rows(rows, fmt, timezone)
+
+
+pool = ExportPool()
@@ -0,0 +1,100 @@
+"""
+Stand-ins for the Telegram objects handlers receive, so tests and benchmarks
+can drive tbot's handlers without the network. Replies are recorded on the
+message instead of being sent.
+"""
+import itertools
+
+
+class FakeUser:
+    def __init__(self, user_id: int):
+        self.id = user_id
+
+
+class FakeDocument:
+    """Stands in for telegram.Document and the File it downloads as."""
+
+    def __init__(self, file_name: str, data: bytes):
+        self.file_name = file_name
+        self.file_size = len(data)
+        self.data = data
+
+    async def get_file(self):
+        return self
+
+    async def download_as_bytearray(self):
+        return bytearray(self.data)
+
+
+class FakeMessage:
+    """Stands in for telegram.Message; replies are recorded instead of sent."""
+
+    ids = itertools.count(1)
+
+    def __init__(self, user_id: int, text: str = "", document: FakeDocument = None, caption: str = None):
+        self.message_id = next(self.ids)
+        self.from_user = FakeUser(user_id)
+        self.text = text
+        self.document = document
+        self.caption = caption
+        self.replies = []
+        self.sent = []
+
+    async def reply_text(self, text, **kwargs):
+        self.replies.append(text)
+        self.sent.append(FakeMessage(self.from_user.id, text))
+        return self.sent[-1]
+
+    async def reply_document(self, document, **kwargs):
+        self.replies.append(document)
+        return FakeMessage(self.from_user.id)
+
+    async def edit_text(self, text, **kwargs):
+        self.text = text
+        return self
+
+    async def delete(self):
+        return True
+
+
+class FakeCallbackQuery:
+    def __init__(self, user_id: int, data: str, message: FakeMessage = None):
+        self.from_user = FakeUser(user_id)
+        self.data = data
+        self.message = message or FakeMessage(user_id)
+        self.answers = []
+
+    async def answer(self, text=None, **kwargs):
+        self.answers.append(text)
+        return True
+
+    async def edit_message_text(self, text, **kwargs):
+        self.message.text = text
+        return self.message
+
+
+class FakeUpdate:
+    ids = itertools.count(1)
+
+    def __init__(self, message=None, callback_query=None, update_id: int = None):
+        self.update_id = next(self.ids) if update_id is None else update_id
+        self.message = message
+        self.callback_query = callback_query
+        self.effective_chat = None
+
+    @property
+    def effective_user(self):
+        source = self.message or self.callback_query
+        return source.from_user if source else None
+
+
+class FakeContext:
+    def __init__(self, args=None, user_data=None):
+        self.args = args or []
+        self.user_data = user_data if user_data is not None else {}
+
+
+def command(user_id: int, text: str):
+    """Build (update, context) for a "/command args" message from user_id."""
+    args = text.split()[1:]
+    return FakeUpdate(message=FakeMessage(user_id, text)), FakeContext(args)
@@ -0,0 +1,168 @@
+"""
+Readers for the files accepted by /import.
+
+They take the same layouts /download writes (see export.py), so an export can
+be loaded back as is. Files are read row by row, straight off the upload, and
+turned into validated task tuples ready for storage.import_tasks(). Like
+exports, parsing runs in an export worker so a large file does not block the
+event loop.
+"""
+import csv
+import gzip
+import io
+import json
+import zipfile
+from datetime import datetime
+
+from openpyxl import load_workbook
+
+import timeutil
+from export import HEADERS
+
+# Columns of an imported task, in the order storage.import_tasks() takes them.
+# The ID column is ignored: imported tasks get new ids.
+IMPORT_COLUMNS = ("task", "who", "category", "tags", "created_at", "updated_at", "completed_at")
+# Errors reported back to the user; the rest are only counted.
+MAX_REPORTED_ERRORS = 10
+
+
+class InvalidImportFile(Exception):
+    pass
+
+
+def column_key(name) -> str:
+    """"Created At" (spreadsheet header) and "created_at" (JSON key) both name created_at."""
+    return str(name or "").strip().lower().replace(" ", "_")
+
+
+def read_xlsx(fileobj):
+    # Read-only workbooks parse the sheet lazily instead of loading every cell.
+    wb = load_workbook(fileobj, read_only=True, data_only=True)
+    try:
+        yield from wb.worksheets[0].iter_rows(values_only=True)
+    finally:
+        wb.close()
+
+
+def read_csv(fileobj):
+    yield from csv.reader(io.TextIOWrapper(fileobj, encoding="utf-8-sig", newline=""))
+
+
+def read_csv_gz(fileobj):
+    with gzip.GzipFile(fileobj=fileobj, mode="rb") as gz:
+        yield from read_csv(gz)
+
+
+def read_jsonl(fileobj):
+    keys = None
+    for line in fileobj:
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError as e:
+            raise InvalidImportFile(f"Not a JSON line: {e}") from None
+        if not isinstance(record, dict):
+            raise InvalidImportFile("Every line must be a JSON object")
+        if keys is None:
+            # Rows come out as lists like the other readers, headed by the
+            # first object's keys.
+            keys = list(record)
+            yield keys
+        yield [record.get(key) for key in keys]
+
+
+# File extension -> reader, the same formats export.FORMATS writes
+FORMATS = {
+    "xlsx": read_xlsx,
+    "csv": read_csv,
+    "csv.gz": read_csv_gz,
+    "jsonl": read_jsonl,
+}
+
+
+def format_for(filename: str):
+    """The import format of filename, judging by its extension, or None."""
+    filename = (filename or "").lower()
+    for fmt in sorted(FORMATS, key=len, reverse=True):
+        if filename.endswith("." + fmt):
+            return fmt
+    return None
+
+
+def timestamp(value, timezone: str):
+    """Epoch seconds of a timestamp cell read as wall-clock time in timezone; None if empty. Raises ValueError."""
+    if value is None or value == "":
+        return None
+    if isinstance(value, datetime):
+        return timeutil.to_epoch(value, timezone)
+    # fromisoformat is several times faster than strptime and also takes the
+    # "2024-01-01T10:00" spellings spreadsheets and scripts tend to produce.
+    return timeutil.parse_timestamp(str(value), timezone)
+
+
+def parse_rows(rows, now: int, timezone: str = timeutil.DEFAULT_TIMEZONE):
+    """
+    Validate the rows of an import file, header first. Returns (tasks, errors,
+    invalid): the valid rows as IMPORT_COLUMNS tuples, the first few error
+    messages and the number of rows skipped. Times are read in timezone, and
+    tasks without a creation time get `now`.
+    """
+    rows = iter(rows)
+    header = next(rows, None)
+    if header is None:
+        raise InvalidImportFile("The file is empty")
+    positions = {}
+    for position, name in enumerate(header):
+        positions.setdefault(column_key(name), position)
+    if "task" not in positions:
+        raise InvalidImportFile(f"Missing a Task column; expected the columns {', '.join(HEADERS)}")
+    columns = [positions.get(key) for key in IMPORT_COLUMNS]
+
+    tasks = []
+    errors = []
+    invalid = 0
+    for number, row in enumerate(rows, start=2):
+        if not any(v not in (None, "") for v in row):
+            continue
+        values = [row[p] if p is not None and p < len(row) else None for p in columns]
+        task, who, category, tags, created_at, updated_at, completed_at = values
+        task = str(task).strip() if task is not None else ""
+        try:
+            if not task:
+                raise ValueError("empty task")
+            created_at, updated_at, completed_at = (
+                timestamp(created_at, timezone),
+                timestamp(updated_at, timezone),
+                timestamp(completed_at, timezone),
+            )
+        except ValueError as e:
+            invalid += 1
+            if len(errors) < MAX_REPORTED_ERRORS:
+                errors.append(f"row {number}: {e}")
+            continue
+        if created_at is None:
+            created_at = now
+        tasks.append(
+            (
+                task,
+                str(who or "").strip(),
+                str(category or "").strip(),
+                str(tags or "").strip(),
+                created_at,
+                updated_at,
+                completed_at,
+            )
+        )
+    return tasks, errors, invalid
+
+
+def parse_file(data: bytes, fmt: str, now: int, timezone: str = timeutil.DEFAULT_TIMEZONE):
+    """Read and validate an uploaded file. Runs inside an export worker; see parse_rows()."""
+    try:
+        return parse_rows(FORMATS[fmt](io.BytesIO(data)), now, timezone)
+    except InvalidImportFile:
+        raise
+    except (ValueError, OSError, KeyError, EOFError, csv.Error, zipfile.BadZipFile) as e:
+        # Whatever a corrupt or mislabelled file makes the readers raise.
+        raise InvalidImportFile(f"Could not read the file as {fmt}: {e}") from None
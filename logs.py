@@ -0,0 +1,148 @@
+"""
+Structured logging that stays off the event loop.
+
+Loggers hand their records to a QueueHandler, which only puts them on an
+in-memory queue; a QueueListener thread formats them as JSON lines and
+writes them to the configured sinks. Records logged while a handler runs
+carry that update's update_id, user_id and handler name (see correlate()).
+Debug records sit on hot paths, so only a sample of them is kept.
+"""
+import contextvars
+import functools
+import json
+import logging
+import logging.handlers
+import queue
+import random
+import sys
+from datetime import datetime, timezone
+
+# Fraction of DEBUG records kept.
+DEBUG_SAMPLE_RATE = 0.01
+
+# Correlation fields of the update being handled.
+update_context = contextvars.ContextVar("update_context", default={})
+
+# Attributes every LogRecord has; anything else was passed in `extra`.
+RECORD_ATTRIBUTES = set(vars(logging.makeLogRecord({}))) | {"message", "asctime", "taskName"}
+
+
+def sink(spec: str) -> str:
+    """Check a --log-sink value: "stderr", "stdout" or "file:PATH". Raises ValueError."""
+    if spec in ("stderr", "stdout") or (spec.startswith("file:") and len(spec) > 5):
+        return spec
+    raise ValueError(f"unknown log sink {spec!r}")
+
+
+def sink_handler(spec: str) -> logging.Handler:
+    sink(spec)
+    if spec == "stdout":
+        return logging.StreamHandler(sys.stdout)
+    if spec == "stderr":
+        return logging.StreamHandler(sys.stderr)
+    return logging.FileHandler(spec[len("file:"):], encoding="utf-8")
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per record: time, level, logger, message, correlation fields and extras."""
+
+    def format(self, record) -> str:
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in RECORD_ATTRIBUTES and not key.startswith("_"):
+                entry[key] = value
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+
+class ContextFilter(logging.Filter):
+    """Stamps records with the correlation fields of the update being handled."""
+
+    def filter(self, record) -> bool:
+        for key, value in update_context.get().items():
+            setattr(record, key, value)
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    """Keeps every record at INFO and above, and a `rate` fraction of the rest."""
+
+    def __init__(self, rate: float, rng=random.random):
+        super().__init__()
+        self.rate = rate
+        self.rng = rng
+
+    def filter(self, record) -> bool:
+        return record.levelno > logging.DEBUG or self.rng() < self.rate
+
+
+class JsonQueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        # Unlike the base class, keep the fields the JsonFormatter needs; only
+        # the parts that may not survive a thread hop are resolved here.
+        record = logging.makeLogRecord(vars(record))
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+def setup(level="INFO", sinks=("stderr",), debug_sample_rate: float = DEBUG_SAMPLE_RATE):
+    """
+    Route the root logger through a queue to the given sinks. Returns the
+    started QueueListener; stop() it on exit to flush what is still queued.
+    """
+    formatter = JsonFormatter()
+    handlers = []
+    for spec in sinks:
+        handler = sink_handler(spec)
+        handler.setFormatter(formatter)
+        handlers.append(handler)
+
+    records = queue.SimpleQueue()
+    queue_handler = JsonQueueHandler(records)
+    queue_handler.addFilter(SamplingFilter(debug_sample_rate))
+    queue_handler.addFilter(ContextFilter())
+
+    root = logging.getLogger()
+    for old in root.handlers[:]:
+        root.removeHandler(old)
+    root.addHandler(queue_handler)
+    root.setLevel(level)
+    # The HTTP client logs every request at INFO.
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+
+    listener = logging.handlers.QueueListener(records, *handlers, respect_handler_level=True)
+    listener.start()
+    return listener
+
+
+def correlate(name: str, handler):
+    """Wrap a PTB handler callback so records logged while it runs carry the update's ids."""
+
+    @functools.wraps(handler)
+    async def wrapper(update, context):
+        user = getattr(update, "effective_user", None)
+        token = update_context.set(
+            {
+                "update_id": getattr(update, "update_id", None),
+                "user_id": user.id if user else None,
+                "handler": name,
+            }
+        )
+        try:
+            return await handler(update, context)
+        finally:
+            update_context.reset(token)
+
+    return wrapper
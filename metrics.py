@@ -0,0 +1,187 @@
+"""
+Prometheus-style metrics of the running bot.
+
+Handlers registered by tbot.build_app() are wrapped by instrument(), which
+times them and counts the ones that fail. While a handler runs, the storage
+pool charges the time it holds a connection and the rows it reads to that
+handler, and the send queue (ratelimit.py) records the size of every message
+going out. registry.render() dumps everything in the Prometheus text format;
+`--metrics-port` serves the same text at /metrics.
+"""
+import contextvars
+import functools
+import time
+from contextlib import contextmanager
+
+from webhook import Request, Response
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+ROW_BUCKETS = (1, 10, 100, 1000, 10000, 100000)
+SIZE_BUCKETS = (64, 256, 1024, 4096, 16384, 65536)
+
+# Name of the handler the current task is running, for charging database work to it.
+current_handler = contextvars.ContextVar("current_handler", default="none")
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(names, values, le=None) -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if le is not None:
+        pairs.append(f'le="{le}"')
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _number(value) -> str:
+    return repr(float(value)) if isinstance(value, float) and not value.is_integer() else str(int(value))
+
+
+class Counter:
+    def __init__(self, name: str, help: str, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values = {}  # label values -> count
+
+    def inc(self, *label_values, amount=1):
+        self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def get(self, *label_values):
+        return self.values.get(label_values, 0)
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} counter"
+        for label_values, value in sorted(self.values.items()):
+            yield f"{self.name}{_labels(self.labels, label_values)} {_number(value)}"
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = tuple(buckets)
+        self.series = {}  # label values -> [count per bucket..., sum, count]
+
+    def observe(self, value, *label_values):
+        series = self.series.get(label_values)
+        if series is None:
+            series = self.series[label_values] = [0] * (len(self.buckets) + 2)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                series[i] += 1
+        series[-2] += value
+        series[-1] += 1
+
+    def count(self, *label_values) -> int:
+        series = self.series.get(label_values)
+        return series[-1] if series else 0
+
+    def sum(self, *label_values):
+        series = self.series.get(label_values)
+        return series[-2] if series else 0
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} histogram"
+        for label_values, series in sorted(self.series.items()):
+            for bound, count in zip(self.buckets, series):
+                yield f"{self.name}_bucket{_labels(self.labels, label_values, _number(bound))} {count}"
+            yield f"{self.name}_bucket{_labels(self.labels, label_values, '+Inf')} {series[-1]}"
+            yield f"{self.name}_sum{_labels(self.labels, label_values)} {_number(series[-2])}"
+            yield f"{self.name}_count{_labels(self.labels, label_values)} {series[-1]}"
+
+
+class Registry:
+    """Every metric the bot records. clock returns seconds; tests pass a fake one."""
+
+    def __init__(self, clock=time.perf_counter):
+        self.clock = clock
+        self.handler_seconds = Histogram(
+            "bot_handler_seconds", "Time spent handling an update", ("handler",)
+        )
+        self.handler_errors = Counter(
+            "bot_handler_errors_total", "Updates whose handler raised", ("handler", "error")
+        )
+        self.db_seconds = Histogram(
+            "bot_db_seconds", "Time a database connection was held", ("handler", "kind")
+        )
+        self.db_rows = Histogram(
+            "bot_db_rows", "Task rows returned by a query", ("handler",), ROW_BUCKETS
+        )
+        self.message_bytes = Histogram(
+            "bot_message_bytes", "Size of the text of outgoing messages", ("endpoint",), SIZE_BUCKETS
+        )
+        self.flood_waits = Counter(
+            "bot_flood_waits_total", "Requests Telegram answered with RetryAfter", ("endpoint",)
+        )
+
+    def metrics(self):
+        return [
+            self.handler_seconds,
+            self.handler_errors,
+            self.db_seconds,
+            self.db_rows,
+            self.message_bytes,
+            self.flood_waits,
+        ]
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+
+def instrument(name: str, handler):
+    """Wrap a PTB handler callback so its latency and failures are recorded under name."""
+
+    @functools.wraps(handler)
+    async def wrapper(update, context):
+        reg = registry
+        token = current_handler.set(name)
+        start = reg.clock()
+        try:
+            return await handler(update, context)
+        except Exception as e:
+            reg.handler_errors.inc(name, type(e).__name__)
+            raise
+        finally:
+            reg.handler_seconds.observe(reg.clock() - start, name)
+            current_handler.reset(token)
+
+    return wrapper
+
+
+@contextmanager
+def db_timer(kind: str):
+    """Record how long the block holds a database connection, charged to the current handler."""
+    reg = registry
+    start = reg.clock()
+    try:
+        yield
+    finally:
+        reg.db_seconds.observe(reg.clock() - start, current_handler.get(), kind)
+
+
+def record_rows(count: int):
+    registry.db_rows.observe(count, current_handler.get())
+
+
+def record_message(endpoint: str, text: str):
+    registry.message_bytes.observe(len(text.encode()), endpoint)
+
+
+def record_flood_wait(endpoint: str):
+    registry.flood_waits.inc(endpoint)
+
+
+async def serve(request: Request) -> Response:
+    """webhook.HttpServer route handler serving the registry at /metrics."""
+    return Response(200, registry.render().encode(), "text/plain; version=0.0.4; charset=utf-8")
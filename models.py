@@ -0,0 +1,60 @@
+"""
+Tortoise ORM models of the tasks schema, used by repository.TortoiseRepository
+to keep tasks in a server database such as PostgreSQL. The SQLite backend
+does not use them: it keeps its own hand-tuned schema (see storage.MIGRATIONS).
+"""
+from tortoise import fields
+from tortoise.models import Model
+
+
+class Task(Model):
+    id = fields.IntField(primary_key=True)
+    user_id = fields.BigIntField(db_index=True)
+    task = fields.TextField()
+    who = fields.TextField(null=True)
+    category = fields.TextField(null=True)
+    tags = fields.TextField(null=True)
+    # Epoch seconds (UTC), like the SQLite schema.
+    created_at = fields.BigIntField()
+    updated_at = fields.BigIntField(null=True)
+    completed_at = fields.BigIntField(null=True)
+
+    class Meta:
+        table = "tasks"
+        indexes = (("user_id", "completed_at", "id"), ("user_id", "created_at"))
+
+
+class TaskTag(Model):
+    id = fields.IntField(primary_key=True)
+    task = fields.ForeignKeyField("models.Task", related_name="task_tags", on_delete=fields.CASCADE)
+    user_id = fields.BigIntField()
+    tag = fields.TextField()
+    # Lower-cased tag: tags match case-insensitively, as in the SQLite schema.
+    key = fields.CharField(max_length=255)
+
+    class Meta:
+        table = "task_tags"
+        unique_together = (("task", "key"),)
+        indexes = (("user_id", "key"),)
+
+
+class UserSetting(Model):
+    user_id = fields.BigIntField(primary_key=True)
+    timezone = fields.TextField(null=True)
+
+    class Meta:
+        table = "user_settings"
+
+
+class Sequence(Model):
+    """
+    Counters handing out ids in blocks. Tasks are inserted with bulk_create,
+    which cannot report the ids the database picked, so their ids are
+    reserved here first (see TortoiseRepository._reserve_ids).
+    """
+
+    name = fields.CharField(max_length=64, primary_key=True)
+    value = fields.BigIntField()
+
+    class Meta:
+        table = "sequences"
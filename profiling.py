@@ -0,0 +1,177 @@
+"""
+Opt-in profiling of the SQL statements run by storage.
+
+When enabled, the storage pool hands out connections wrapped in
+ProfiledConnection, which times every statement from execution until its
+cursor is closed (so fetching the rows counts too). Timings are aggregated by
+statement shape: the SQL with literals replaced by "?" and placeholder lists
+collapsed, so each combination of /list filters shows up as one line.
+Statements slower than the threshold are logged together with their
+EXPLAIN QUERY PLAN. Admins toggle it at runtime with /profile.
+"""
+import functools
+import logging
+import re
+import sqlite3
+import time
+from collections import deque
+
+# Statements slower than this (milliseconds) have their plan captured and logged.
+SLOW_QUERY_MS = 50
+# Distinct shapes tracked; statements of further shapes are counted under OTHER.
+MAX_SHAPES = 500
+OTHER = "(other)"
+# Slow statements kept for the report.
+MAX_SLOW = 50
+EXPLAINABLE = ("SELECT", "INSERT", "UPDATE", "DELETE", "WITH", "REPLACE")
+
+log = logging.getLogger("profiling")
+
+
+@functools.lru_cache(maxsize=1024)
+def normalize(sql: str) -> str:
+    """The shape of sql: literals become ?, "(?, ?, ?)" becomes "(?, ...)", whitespace is collapsed."""
+    shape = re.sub(r"'(?:[^']|'')*'", "?", sql)
+    shape = re.sub(r"\b\d+(?:\.\d+)?\b", "?", shape)
+    shape = re.sub(r"\(\s*\?(?:\s*,\s*\?)+\s*\)", "(?, ...)", shape)
+    return " ".join(shape.split())
+
+
+class ShapeStats:
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.slow = 0
+        self.plan = None  # plan of the slowest captured run
+
+    @property
+    def mean(self) -> float:
+        return self.total / self.count if self.count else 0.0
+
+
+class QueryProfiler:
+    def __init__(self, threshold_ms: float = SLOW_QUERY_MS, clock=time.perf_counter):
+        self.enabled = False
+        self.threshold_ms = threshold_ms
+        self.clock = clock
+        self.shapes = {}  # shape -> ShapeStats
+        self.slow = deque(maxlen=MAX_SLOW)  # (elapsed_ms, shape, plan)
+
+    def wrap(self, conn):
+        """conn itself while profiling is off, otherwise a timing proxy of it."""
+        return ProfiledConnection(conn, self) if self.enabled else conn
+
+    def reset(self):
+        self.shapes = {}
+        self.slow.clear()
+
+    async def record(self, conn, sql: str, params, elapsed: float):
+        shape = normalize(sql)
+        stats = self.shapes.get(shape)
+        if stats is None:
+            if len(self.shapes) >= MAX_SHAPES:
+                shape = OTHER
+            stats = self.shapes.setdefault(shape, ShapeStats())
+        elapsed_ms = elapsed * 1000
+        stats.count += 1
+        stats.total += elapsed_ms
+        if elapsed_ms <= self.threshold_ms:
+            stats.max = max(stats.max, elapsed_ms)
+            return
+        stats.slow += 1
+        plan = await explain(conn, sql, params)
+        if elapsed_ms >= stats.max:
+            stats.plan = plan
+        stats.max = max(stats.max, elapsed_ms)
+        self.slow.append((elapsed_ms, shape, plan))
+        log.warning("slow query", extra={"ms": round(elapsed_ms, 2), "sql": shape, "plan": plan})
+
+    def report(self, top: int = 10) -> str:
+        """Plain-text table of the top shapes by total time, with the plan of their slowest run."""
+        if not self.shapes:
+            return "No statements profiled yet."
+        lines = []
+        ranked = sorted(self.shapes.items(), key=lambda item: item[1].total, reverse=True)
+        for shape, stats in ranked[:top]:
+            lines.append(
+                f"{stats.total:9.1f}ms total  {stats.count:6d}x  mean {stats.mean:7.2f}ms  "
+                f"max {stats.max:7.2f}ms  slow {stats.slow}"
+            )
+            lines.append(f"  {shape}")
+            if stats.plan:
+                lines.extend(f"    {step}" for step in stats.plan.splitlines())
+        return "\n".join(lines)
+
+
+async def explain(conn, sql: str, params) -> str:
+    """EXPLAIN QUERY PLAN of sql as indented text, or None if it has none."""
+    if not sql.lstrip().upper().startswith(EXPLAINABLE):
+        return None
+    try:
+        async with conn.execute("EXPLAIN QUERY PLAN " + sql, params) as cursor:
+            rows = await cursor.fetchall()
+    except sqlite3.Error:
+        return None
+    depth = {0: 0}
+    lines = []
+    for node, parent, _, detail in rows:
+        depth[node] = depth.get(parent, 0) + 1
+        lines.append("  " * (depth[node] - 1) + detail)
+    return "\n".join(lines)
+
+
+class ProfiledStatement:
+    """What ProfiledConnection.execute() returns: awaitable, or usable with `async with` like aiosqlite's."""
+
+    def __init__(self, conn: "ProfiledConnection", sql: str, params):
+        self.conn = conn
+        self.sql = sql
+        self.params = params
+        self.cursor = None
+        self.start = None
+
+    def __await__(self):
+        return self._run().__await__()
+
+    async def _run(self):
+        start = self.conn.profiler.clock()
+        cursor = await self.conn.conn.execute(self.sql, self.params)
+        await self.conn.profiler.record(self.conn.conn, self.sql, self.params, self.conn.profiler.clock() - start)
+        return cursor
+
+    async def __aenter__(self):
+        self.start = self.conn.profiler.clock()
+        self.cursor = await self.conn.conn.execute(self.sql, self.params)
+        return self.cursor
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.cursor.close()
+        if exc_type is None:
+            elapsed = self.conn.profiler.clock() - self.start
+            await self.conn.profiler.record(self.conn.conn, self.sql, self.params, elapsed)
+
+
+class ProfiledConnection:
+    """Times execute() and executemany() on an aiosqlite connection; everything else passes through."""
+
+    def __init__(self, conn, profiler: QueryProfiler):
+        self.conn = conn
+        self.profiler = profiler
+
+    def execute(self, sql: str, parameters=()):
+        return ProfiledStatement(self, sql, parameters)
+
+    async def executemany(self, sql: str, parameters):
+        parameters = list(parameters)
+        start = self.profiler.clock()
+        cursor = await self.conn.executemany(sql, parameters)
+        # Planned with the first row's values; they all share a plan.
+        await self.profiler.record(self.conn, sql, parameters[0] if parameters else (), self.profiler.clock() - start)
+        return cursor
+
+    def __getattr__(self, name):
+        return getattr(self.conn, name)
+
+
+queries = QueryProfiler()
@@ -0,0 +1,245 @@
+"""
+Flood-control aware scheduling of the bot's outgoing requests.
+
+Every Bot API call made by the handlers (reply_text, edit_message_text,
+reply_document, ...) passes through SendScheduler, plugged in with
+ApplicationBuilder.rate_limiter(). Requests wait for a token from a global
+bucket and from a bucket of the chat they go to, so bursts are spread out
+instead of being answered with 429 errors. Interactive replies go ahead of
+bulk uploads such as exports, repeated edits of a message that is still
+waiting are merged into one, and a RetryAfter from Telegram pauses sending
+for as long as it asks before the request is tried again.
+"""
+import asyncio
+import bisect
+import datetime as dt
+import itertools
+import logging
+import time
+import warnings
+
+from telegram.error import RetryAfter
+from telegram.warnings import PTBDeprecationWarning
+
+import metrics
+from telegram.ext import BaseRateLimiter
+
+# Telegram allows about 30 messages per second overall, one per second in a
+# private chat (short bursts are tolerated) and 20 per minute in a group.
+GLOBAL_RATE = 30
+CHAT_RATE = 1
+GROUP_RATE = 20 / 60
+CHAT_BURST = 3
+# Attempts after a RetryAfter before the error is passed on to the handler.
+MAX_RETRIES = 3
+
+# Lower goes first.
+INTERACTIVE = 0
+BULK = 1
+BULK_ENDPOINTS = {"sendDocument", "sendPhoto", "sendVideo", "sendAudio", "sendMediaGroup"}
+EDIT_ENDPOINTS = {"editMessageText", "editMessageReplyMarkup", "editMessageCaption"}
+
+log = logging.getLogger("ratelimit")
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float, now: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = now
+
+    def wait_time(self, now: float) -> float:
+        """Seconds until a token is available; 0 if one is available now."""
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+
+class Job:
+    def __init__(self, priority: int, seq: int, chat_id, callback, args, kwargs):
+        self.priority = priority
+        self.seq = seq
+        self.chat_id = chat_id
+        self.callback = callback
+        self.args = args
+        self.kwargs = kwargs
+        self.released = asyncio.get_running_loop().create_future()
+        self.result = None  # future shared with merged edits, created on the first merge
+
+    def __lt__(self, other):
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+
+def retry_seconds(error: RetryAfter) -> float:
+    with warnings.catch_warnings():
+        # Reading it as a number is deprecated in favour of a timedelta.
+        warnings.simplefilter("ignore", PTBDeprecationWarning)
+        retry_after = error.retry_after
+    if isinstance(retry_after, dt.timedelta):
+        return retry_after.total_seconds()
+    return float(retry_after)
+
+
+class SendScheduler(BaseRateLimiter):
+    """
+    Releases queued requests one at a time, best priority first, as soon as
+    both the global bucket and the bucket of the request's chat have a token.
+    Requests without a chat (answering callback queries, fetching files) only
+    wait out RetryAfter pauses. Pass rate_limit_args={"priority": BULK} to
+    queue any request behind the interactive ones.
+    """
+
+    def __init__(
+        self,
+        global_rate: float = GLOBAL_RATE,
+        chat_rate: float = CHAT_RATE,
+        group_rate: float = GROUP_RATE,
+        chat_burst: float = CHAT_BURST,
+        max_retries: int = MAX_RETRIES,
+    ):
+        self.global_rate = global_rate
+        self.chat_rate = chat_rate
+        self.group_rate = group_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self.retries = 0
+        self.merged_edits = 0
+        self._global = None
+        self._chats = {}  # chat_id -> TokenBucket
+        self._waiting = []  # Jobs waiting for their turn, sorted by (priority, seq)
+        self._edits = {}  # (endpoint, chat_id, message_id) -> waiting Job editing that message
+        self._paused_until = 0.0
+        self._seq = itertools.count()
+        self._wakeup = None
+        self._dispatcher = None
+
+    async def initialize(self):
+        if self._dispatcher is None:
+            self._global = TokenBucket(self.global_rate, self.global_rate, time.monotonic())
+            self._wakeup = asyncio.Event()
+            self._dispatcher = asyncio.create_task(self._dispatch())
+
+    async def shutdown(self):
+        if self._dispatcher is not None:
+            self._dispatcher.cancel()
+            try:
+                await self._dispatcher
+            except asyncio.CancelledError:
+                pass
+            self._dispatcher = None
+
+    @property
+    def queued(self) -> int:
+        return len(self._waiting)
+
+    def _bucket(self, chat_id) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            # Group and channel ids are negative.
+            rate = self.group_rate if isinstance(chat_id, int) and chat_id < 0 else self.chat_rate
+            bucket = self._chats[chat_id] = TokenBucket(rate, self.chat_burst, time.monotonic())
+        return bucket
+
+    def _next_job(self, now: float):
+        """The job to release now, or None and the seconds until one can be (None: no job waiting)."""
+        if now < self._paused_until:
+            return None, self._paused_until - now
+        global_wait = self._global.wait_time(now)
+        delay = None
+        for job in self._waiting:
+            if job.chat_id is None:
+                return job, 0.0
+            wait = max(global_wait, self._bucket(job.chat_id).wait_time(now))
+            if wait <= 0:
+                return job, 0.0
+            delay = wait if delay is None else min(delay, wait)
+        return None, delay
+
+    async def _dispatch(self):
+        while True:
+            job, delay = self._next_job(time.monotonic())
+            if job is not None:
+                self._release(job)
+                continue
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+
+    def _release(self, job: Job):
+        self._waiting.remove(job)
+        if job.chat_id is not None:
+            self._global.take()
+            self._bucket(job.chat_id).take()
+        job.released.set_result(None)
+
+    def _enqueue(self, job: Job):
+        bisect.insort(self._waiting, job)
+        self._wakeup.set()
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        if self._dispatcher is None:
+            await self.initialize()
+        chat_id = data.get("chat_id")
+        text = data.get("text") or data.get("caption")
+        if isinstance(text, str):
+            metrics.record_message(endpoint, text)
+        key = None
+        if endpoint in EDIT_ENDPOINTS and data.get("message_id") is not None:
+            key = (endpoint, chat_id, data["message_id"])
+            job = self._edits.get(key)
+            if job is not None:
+                # The earlier edit has not been sent yet: send only this one,
+                # and answer both callers with its result.
+                job.callback, job.args, job.kwargs = callback, args, kwargs
+                if job.result is None:
+                    job.result = asyncio.get_running_loop().create_future()
+                self.merged_edits += 1
+                return await asyncio.shield(job.result)
+
+        priority = (rate_limit_args or {}).get("priority")
+        if priority is None:
+            priority = BULK if endpoint in BULK_ENDPOINTS else INTERACTIVE
+        job = Job(priority, next(self._seq), chat_id, callback, args, kwargs)
+        try:
+            for attempt in itertools.count():
+                if key is not None:
+                    self._edits.setdefault(key, job)
+                self._enqueue(job)
+                try:
+                    await job.released
+                finally:
+                    if job in self._waiting:
+                        self._waiting.remove(job)
+                    if key is not None and self._edits.get(key) is job:
+                        del self._edits[key]
+                try:
+                    result = await job.callback(*job.args, **job.kwargs)
+                except RetryAfter as e:
+                    if attempt >= self.max_retries:
+                        raise
+                    # Nothing goes out until the flood wait is over; this
+                    # request keeps its place in the queue.
+                    self.retries += 1
+                    metrics.record_flood_wait(endpoint)
+                    wait = retry_seconds(e)
+                    log.warning("flood wait", extra={"endpoint": endpoint, "chat_id": chat_id, "retry_after": wait})
+                    self._paused_until = max(self._paused_until, time.monotonic() + wait)
+                    job.released = asyncio.get_running_loop().create_future()
+                    continue
+                if job.result is not None:
+                    job.result.set_result(result)
+                return result
+        except asyncio.CancelledError:
+            if job.result is not None:
+                job.result.cancel()
+            raise
+        except Exception as e:
+            if job.result is not None:
+                job.result.set_exception(e)
+            raise
@@ -0,0 +1,783 @@
+"""
+Async storage layer for the todo bot.
+
+All database access goes through the coroutines below so that handlers never
+block the event loop while SQLite is busy. Connections come from a long-lived
+Pool (one writer, several readers) opened once at startup with open_pool().
+"""
+import asyncio
+import json
+import re
+import sqlite3
+from contextlib import asynccontextmanager
+
+import aiosqlite
+
+import cache
+import metrics
+import profiling
+import timeutil
+
+DB_NAME = "tasks.db"
+READERS = 4
+PAGE_SIZE = 20
+# Rows inserted per transaction by import_tasks().
+IMPORT_CHUNK_SIZE = 5000
+# Size of each connection's prepared statement cache. Every statement below is
+# built from a small, fixed set of SQL strings, so they are compiled once per
+# connection and reused afterwards.
+STATEMENT_CACHE_SIZE = 256
+
+PRAGMAS = [
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA busy_timeout=5000",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-16000",
+    "PRAGMA foreign_keys=ON",
+]
+
+TASK_COLUMNS = "id, task, who, category, tags, created_at, updated_at, completed_at"
+# Same columns qualified with the table name, for queries that join tasks_fts
+# (which has its own `task` column).
+QUALIFIED_TASK_COLUMNS = ", ".join(f"tasks.{c}" for c in TASK_COLUMNS.split(", "))
+
+
+class Pool:
+    """
+    One writer connection and a fixed set of reader connections to the same
+    SQLite file. With WAL enabled readers never block the writer (nor each
+    other), and funnelling all writes through a single connection guarded by
+    a lock means writers never fight over the database lock.
+    """
+
+    def __init__(self, path: str, readers: int = READERS):
+        self.path = path
+        self.readers = readers
+        self._writer = None
+        self._write_lock = asyncio.Lock()
+        self._idle_readers = asyncio.Queue()
+        self._all_readers = []
+
+    async def _connect(self, read_only: bool):
+        conn = await aiosqlite.connect(self.path, cached_statements=STATEMENT_CACHE_SIZE)
+        for pragma in PRAGMAS:
+            await conn.execute(pragma)
+        if read_only:
+            await conn.execute("PRAGMA query_only=ON")
+        return conn
+
+    async def open(self):
+        # The writer is opened first so that WAL mode is set on the file
+        # before any reader attaches to it.
+        self._writer = await self._connect(read_only=False)
+        await _create_schema(self._writer)
+        for _ in range(self.readers):
+            conn = await self._connect(read_only=True)
+            self._all_readers.append(conn)
+            self._idle_readers.put_nowait(conn)
+
+    async def close(self):
+        if self._writer is not None:
+            # Refresh planner statistics for the indexes the workload used.
+            await self._writer.execute("PRAGMA optimize")
+        for conn in self._all_readers:
+            await conn.close()
+        self._all_readers = []
+        self._idle_readers = asyncio.Queue()
+        if self._writer is not None:
+            await self._writer.close()
+            self._writer = None
+
+    @asynccontextmanager
+    async def reader(self):
+        conn = await self._idle_readers.get()
+        try:
+            with metrics.db_timer("read"):
+                yield profiling.queries.wrap(conn)
+        finally:
+            self._idle_readers.put_nowait(conn)
+
+    @asynccontextmanager
+    async def writer(self):
+        """Exclusive access to the writer; commits on success, rolls back on error."""
+        async with self._write_lock:
+            with metrics.db_timer("write"):
+                try:
+                    yield profiling.queries.wrap(self._writer)
+                except BaseException:
+                    await self._writer.rollback()
+                    raise
+                await self._writer.commit()
+
+
+_pool = None
+
+
+async def open_pool(path: str = None, readers: int = READERS) -> Pool:
+    """Open the module-wide connection pool, creating the schema if needed."""
+    global _pool
+    if _pool is not None:
+        await close_pool()
+    pool = Pool(path or DB_NAME, readers)
+    await pool.open()
+    _pool = pool
+    # Nothing cached so far describes this database.
+    cache.pages.clear()
+    return pool
+
+
+async def close_pool():
+    global _pool
+    if _pool is not None:
+        await _pool.close()
+        _pool = None
+
+
+def get_pool() -> Pool:
+    if _pool is None:
+        raise RuntimeError("Storage pool is not open; call open_pool() first.")
+    return _pool
+
+
+# Schema migrations, applied in order. The database's PRAGMA user_version
+# records how many have run; each one is applied in its own transaction
+# together with the version bump. Never edit a released migration, append a
+# new one instead.
+MIGRATIONS = [
+    # 1: initial schema
+    """
+    CREATE TABLE IF NOT EXISTS tasks (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        task TEXT NOT NULL,
+        who TEXT,
+        category TEXT,
+        tags TEXT,
+        created_at TEXT NOT NULL,
+        updated_at TEXT,
+        completed_at TEXT
+    );
+    """,
+    # 2: every query filters on user_id and most on completed_at IS NULL
+    """
+    CREATE INDEX IF NOT EXISTS idx_tasks_user_open ON tasks (user_id, completed_at, id);
+    """,
+    # 3: full-text index over the task description, kept in sync by triggers
+    """
+    CREATE VIRTUAL TABLE IF NOT EXISTS tasks_fts USING fts5(
+        task, content='tasks', content_rowid='id', tokenize='unicode61 remove_diacritics 2'
+    );
+    CREATE TRIGGER IF NOT EXISTS tasks_fts_insert AFTER INSERT ON tasks BEGIN
+        INSERT INTO tasks_fts (rowid, task) VALUES (new.id, new.task);
+    END;
+    CREATE TRIGGER IF NOT EXISTS tasks_fts_delete AFTER DELETE ON tasks BEGIN
+        INSERT INTO tasks_fts (tasks_fts, rowid, task) VALUES ('delete', old.id, old.task);
+    END;
+    CREATE TRIGGER IF NOT EXISTS tasks_fts_update AFTER UPDATE OF task ON tasks BEGIN
+        INSERT INTO tasks_fts (tasks_fts, rowid, task) VALUES ('delete', old.id, old.task);
+        INSERT INTO tasks_fts (rowid, task) VALUES (new.id, new.task);
+    END;
+    INSERT INTO tasks_fts (tasks_fts) VALUES ('rebuild');
+    """,
+    # 4: one row per (task, tag) so tag filters are exact index lookups
+    """
+    CREATE TABLE IF NOT EXISTS task_tags (
+        task_id INTEGER NOT NULL REFERENCES tasks (id) ON DELETE CASCADE,
+        user_id INTEGER,
+        tag TEXT NOT NULL COLLATE NOCASE,
+        PRIMARY KEY (task_id, tag)
+    ) WITHOUT ROWID;
+    CREATE INDEX IF NOT EXISTS idx_task_tags_tag ON task_tags (user_id, tag, task_id);
+    WITH RECURSIVE split (task_id, user_id, tag, rest) AS (
+        SELECT id, user_id, '', COALESCE(tags, '') || ',' FROM tasks
+        UNION ALL
+        SELECT task_id, user_id, trim(substr(rest, 1, instr(rest, ',') - 1)), substr(rest, instr(rest, ',') + 1)
+        FROM split WHERE rest <> ''
+    )
+    INSERT OR IGNORE INTO task_tags (task_id, user_id, tag)
+    SELECT task_id, user_id, tag FROM split WHERE tag <> '';
+    """,
+    # 5: keyset pagination over all of a user's tasks, completed ones included
+    """
+    CREATE INDEX IF NOT EXISTS idx_tasks_user_id ON tasks (user_id, id);
+    """,
+    # 6: FTS5 flushes its pending terms every time the insert trigger runs, so
+    # batches index their rows with one statement instead; the trigger stands
+    # aside while bulk_insert holds a row
+    """
+    CREATE TABLE IF NOT EXISTS bulk_insert (active INTEGER);
+    DROP TRIGGER IF EXISTS tasks_fts_insert;
+    CREATE TRIGGER tasks_fts_insert AFTER INSERT ON tasks WHEN NOT EXISTS (SELECT 1 FROM bulk_insert) BEGIN
+        INSERT INTO tasks_fts (rowid, task) VALUES (new.id, new.task);
+    END;
+    """,
+    # 7: timestamps become integer seconds since the epoch (UTC). SQLite cannot
+    # change a column's type in place, so the table is rebuilt; the old text
+    # values were written in the server's local time.
+    """
+    CREATE TABLE tasks_new (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        task TEXT NOT NULL,
+        who TEXT,
+        category TEXT,
+        tags TEXT,
+        created_at INTEGER NOT NULL,
+        updated_at INTEGER,
+        completed_at INTEGER
+    );
+    INSERT INTO tasks_new (id, user_id, task, who, category, tags, created_at, updated_at, completed_at)
+    SELECT id, user_id, task, who, category, tags,
+        COALESCE(CAST(strftime('%s', created_at, 'utc') AS INTEGER), CAST(strftime('%s', 'now') AS INTEGER)),
+        CAST(strftime('%s', updated_at, 'utc') AS INTEGER),
+        CAST(strftime('%s', completed_at, 'utc') AS INTEGER)
+    FROM tasks;
+    -- Keep handing out ids above any ever used, deleted tasks included.
+    DELETE FROM sqlite_sequence WHERE name = 'tasks_new';
+    INSERT INTO sqlite_sequence (name, seq) SELECT 'tasks_new', seq FROM sqlite_sequence WHERE name = 'tasks';
+    DROP TABLE tasks;
+    ALTER TABLE tasks_new RENAME TO tasks;
+    CREATE INDEX idx_tasks_user_open ON tasks (user_id, completed_at, id);
+    CREATE INDEX idx_tasks_user_id ON tasks (user_id, id);
+    CREATE INDEX idx_tasks_user_created ON tasks (user_id, created_at);
+    CREATE TRIGGER tasks_fts_insert AFTER INSERT ON tasks WHEN NOT EXISTS (SELECT 1 FROM bulk_insert) BEGIN
+        INSERT INTO tasks_fts (rowid, task) VALUES (new.id, new.task);
+    END;
+    CREATE TRIGGER tasks_fts_delete AFTER DELETE ON tasks BEGIN
+        INSERT INTO tasks_fts (tasks_fts, rowid, task) VALUES ('delete', old.id, old.task);
+    END;
+    CREATE TRIGGER tasks_fts_update AFTER UPDATE OF task ON tasks BEGIN
+        INSERT INTO tasks_fts (tasks_fts, rowid, task) VALUES ('delete', old.id, old.task);
+        INSERT INTO tasks_fts (rowid, task) VALUES (new.id, new.task);
+    END;
+    """,
+    # 8: per-user settings, starting with the timezone times are shown in
+    """
+    CREATE TABLE IF NOT EXISTS user_settings (
+        user_id INTEGER PRIMARY KEY,
+        timezone TEXT
+    );
+    """,
+    # 9: open/done counts per user by status, category, who and tag, plus done
+    # counts per week of completion (UTC, keyed by the Monday), kept current by
+    # triggers so /stats reads a handful of rows instead of every task. Like
+    # the full-text index, batch inserts count their rows in one go instead
+    # (see STATS_BULK_UPSERT).
+    """
+    CREATE TABLE IF NOT EXISTS user_stats (
+        user_id INTEGER NOT NULL,
+        dimension TEXT NOT NULL,
+        value TEXT NOT NULL COLLATE NOCASE,
+        open INTEGER NOT NULL DEFAULT 0,
+        done INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (user_id, dimension, value)
+    ) WITHOUT ROWID;
+
+    CREATE TRIGGER user_stats_insert AFTER INSERT ON tasks WHEN NOT EXISTS (SELECT 1 FROM bulk_insert) BEGIN
+        INSERT INTO user_stats (user_id, dimension, value, open, done) VALUES
+            (new.user_id, 'status', '', new.completed_at IS NULL, new.completed_at IS NOT NULL),
+            (new.user_id, 'category', COALESCE(new.category, ''), new.completed_at IS NULL, new.completed_at IS NOT NULL),
+            (new.user_id, 'who', COALESCE(new.who, ''), new.completed_at IS NULL, new.completed_at IS NOT NULL)
+        ON CONFLICT (user_id, dimension, value) DO UPDATE SET open = open + excluded.open, done = done + excluded.done;
+        INSERT INTO user_stats (user_id, dimension, value, open, done)
+        SELECT new.user_id, 'week', date(new.completed_at, 'unixepoch', 'weekday 0', '-6 days'), 0, 1
+        WHERE new.completed_at IS NOT NULL
+        ON CONFLICT (user_id, dimension, value) DO UPDATE SET done = done + 1;
+    END;
+
+    CREATE TRIGGER user_stats_delete AFTER DELETE ON tasks BEGIN
+        UPDATE user_stats SET open = open - (old.completed_at IS NULL), done = done - (old.completed_at IS NOT NULL)
+        WHERE user_id = old.user_id AND (dimension, value) IN (
+            VALUES ('status', ''), ('category', COALESCE(old.category, '')), ('who', COALESCE(old.who, ''))
+        );
+        UPDATE user_stats SET done = done - 1
+        WHERE old.completed_at IS NOT NULL AND user_id = old.user_id
+            AND dimension = 'week' AND value = date(old.completed_at, 'unixepoch', 'weekday 0', '-6 days');
+    END;
+
+    CREATE TRIGGER user_stats_update AFTER UPDATE OF category, who, completed_at ON tasks BEGIN
+        UPDATE user_stats SET open = open - (old.completed_at IS NULL), done = done - (old.completed_at IS NOT NULL)
+        WHERE user_id = old.user_id AND (dimension, value) IN (
+            VALUES ('status', ''), ('category', COALESCE(old.category, '')), ('who', COALESCE(old.who, ''))
+        );
+        UPDATE user_stats SET done = done - 1
+        WHERE old.completed_at IS NOT NULL AND user_id = old.user_id
+            AND dimension = 'week' AND value = date(old.completed_at, 'unixepoch', 'weekday 0', '-6 days');
+        INSERT INTO user_stats (user_id, dimension, value, open, done) VALUES
+            (new.user_id, 'status', '', new.completed_at IS NULL, new.completed_at IS NOT NULL),
+            (new.user_id, 'category', COALESCE(new.category, ''), new.completed_at IS NULL, new.completed_at IS NOT NULL),
+            (new.user_id, 'who', COALESCE(new.who, ''), new.completed_at IS NULL, new.completed_at IS NOT NULL)
+        ON CONFLICT (user_id, dimension, value) DO UPDATE SET open = open + excluded.open, done = done + excluded.done;
+        INSERT INTO user_stats (user_id, dimension, value, open, done)
+        SELECT new.user_id, 'week', date(new.completed_at, 'unixepoch', 'weekday 0', '-6 days'), 0, 1
+        WHERE new.completed_at IS NOT NULL
+        ON CONFLICT (user_id, dimension, value) DO UPDATE SET done = done + 1;
+        -- The task's tags move between open and done with it.
+        UPDATE user_stats
+        SET open = open + (new.completed_at IS NULL) - (old.completed_at IS NULL),
+            done = done + (new.completed_at IS NOT NULL) - (old.completed_at IS NOT NULL)
+        WHERE (old.completed_at IS NULL) <> (new.completed_at IS NULL)
+            AND user_id = new.user_id AND dimension = 'tag'
+            AND value IN (SELECT tag FROM task_tags WHERE task_id = new.id);
+    END;
+
+    CREATE TRIGGER user_stats_tag_insert AFTER INSERT ON task_tags WHEN NOT EXISTS (SELECT 1 FROM bulk_insert) BEGIN
+        INSERT INTO user_stats (user_id, dimension, value, open, done)
+        SELECT new.user_id, 'tag', new.tag, completed_at IS NULL, completed_at IS NOT NULL
+        FROM tasks WHERE id = new.task_id
+        ON CONFLICT (user_id, dimension, value) DO UPDATE SET open = open + excluded.open, done = done + excluded.done;
+    END;
+
+    CREATE TRIGGER user_stats_tag_delete AFTER DELETE ON task_tags BEGIN
+        UPDATE user_stats
+        SET open = open - (SELECT completed_at IS NULL FROM tasks WHERE id = old.task_id),
+            done = done - (SELECT completed_at IS NOT NULL FROM tasks WHERE id = old.task_id)
+        WHERE user_id = old.user_id AND dimension = 'tag' AND value = old.tag;
+    END;
+
+    -- Tag counts need the task's status, so a task's tags are removed while
+    -- the task is still there to look it up, ahead of the foreign key cascade.
+    CREATE TRIGGER tasks_delete_tags BEFORE DELETE ON tasks BEGIN
+        DELETE FROM task_tags WHERE task_id = old.id;
+    END;
+
+    INSERT INTO user_stats (user_id, dimension, value, open, done)
+    SELECT user_id, 'status', '', SUM(completed_at IS NULL), SUM(completed_at IS NOT NULL)
+    FROM tasks GROUP BY user_id
+    UNION ALL
+    SELECT user_id, 'category', COALESCE(category, ''), SUM(completed_at IS NULL), SUM(completed_at IS NOT NULL)
+    FROM tasks GROUP BY user_id, COALESCE(category, '') COLLATE NOCASE
+    UNION ALL
+    SELECT user_id, 'who', COALESCE(who, ''), SUM(completed_at IS NULL), SUM(completed_at IS NOT NULL)
+    FROM tasks GROUP BY user_id, COALESCE(who, '') COLLATE NOCASE
+    UNION ALL
+    SELECT task_tags.user_id, 'tag', tag, SUM(completed_at IS NULL), SUM(completed_at IS NOT NULL)
+    FROM task_tags JOIN tasks ON tasks.id = task_tags.task_id GROUP BY task_tags.user_id, tag
+    UNION ALL
+    SELECT user_id, 'week', date(completed_at, 'unixepoch', 'weekday 0', '-6 days'), 0, COUNT(*)
+    FROM tasks WHERE completed_at IS NOT NULL GROUP BY user_id, 3;
+    """,
+]
+
+
+async def _create_schema(conn):
+    async with conn.execute("PRAGMA user_version") as cursor:
+        (version,) = await cursor.fetchone()
+    # Rebuilding a table drops the old one, which with foreign keys enforced
+    # would cascade into task_tags. The setting cannot change inside a
+    # transaction, so it is switched off around all of them.
+    await conn.execute("PRAGMA foreign_keys=OFF")
+    try:
+        for number, script in enumerate(MIGRATIONS, start=1):
+            if number <= version:
+                continue
+            await conn.executescript(f"BEGIN;\n{script}\nPRAGMA user_version={number};\nCOMMIT;")
+    finally:
+        await conn.execute("PRAGMA foreign_keys=ON")
+
+
+def split_tags(tags: str) -> list:
+    """Split a comma separated tags string into its distinct, trimmed tags."""
+    result = []
+    seen = set()
+    for tag in (tags or "").split(","):
+        tag = tag.strip()
+        if tag and tag.lower() not in seen:
+            seen.add(tag.lower())
+            result.append(tag)
+    return result
+
+
+FTS_SYNTAX = re.compile(r'["*()^]|\b(AND|OR|NOT|NEAR)\b')
+
+
+def fts_query(text: str) -> str:
+    """
+    Translate a task= filter into an FTS5 MATCH expression.
+
+    Input that already uses FTS syntax (quoted phrases, prefix stars, AND/OR/NOT,
+    parentheses) is passed through unchanged. Plain words are each turned into
+    a quoted prefix term, so "task=mil" still finds "milk" as it did with LIKE.
+    """
+    if FTS_SYNTAX.search(text):
+        return text
+    terms = ['"' + word.replace('"', '""') + '"*' for word in text.split()]
+    return " ".join(terms)
+
+
+# How FTS5 reports a MATCH expression it cannot parse.
+FTS_QUERY_ERRORS = ("fts5: syntax error", "unterminated string", "unknown special query")
+
+
+def is_search_syntax_error(error: sqlite3.OperationalError, text: str) -> bool:
+    """
+    Whether error comes from FTS5 failing to parse the task= search text, as
+    opposed to a locked or broken database.
+    """
+    message = str(error)
+    if message.startswith(FTS_QUERY_ERRORS):
+        return True
+    # FTS5 reads "word:" and "-word" as column filters.
+    column = message.removeprefix("no such column: ")
+    return column != message and column in re.findall(r"\w+", text)
+
+
+# Date range filters of /list (epoch seconds) and the condition each adds.
+RANGE_FILTERS = {
+    "created_from": "tasks.created_at >= ?",
+    "created_until": "tasks.created_at < ?",
+    "completed_from": "tasks.completed_at >= ?",
+}
+
+
+def build_task_query(
+    user_id: int,
+    filters: dict,
+    full_text: bool = True,
+    after: int = None,
+    before: int = None,
+    limit: int = None,
+):
+    """
+    Build the SELECT used by /list. Returns (sql, params).
+
+    The task= filter goes through the tasks_fts index; with full_text=False it
+    falls back to a LIKE substring match. status is open (the default), done
+    or all; show_completed=1 is the older spelling of all. RANGE_FILTERS
+    bound the creation and completion times. Rows come in id order. With a
+    limit the query returns one keyset page: the rows right after the id
+    `after`, or, going backwards, the rows right before the id `before` (in
+    descending id order).
+    """
+    search = filters.get("task", "").strip()
+    use_fts = full_text and bool(search)
+    if use_fts:
+        # CROSS JOIN pins the join order: left to itself the planner walks the
+        # user's tasks and re-runs the full-text query for every one of them.
+        query = (
+            f"SELECT {QUALIFIED_TASK_COLUMNS} FROM tasks_fts CROSS JOIN tasks ON tasks.id = tasks_fts.rowid"
+            " WHERE tasks_fts MATCH ? AND tasks.user_id=?"
+        )
+        params = [fts_query(search), user_id]
+    else:
+        query = f"SELECT {QUALIFIED_TASK_COLUMNS} FROM tasks WHERE tasks.user_id=?"
+        params = [user_id]
+
+    if "task" in filters and not use_fts:
+        query += " AND tasks.task LIKE ?"
+        params.append(f"%{filters['task']}%")
+    if "who" in filters:
+        query += " AND tasks.who LIKE ?"
+        params.append(f"%{filters['who']}%")
+    if "category" in filters:
+        query += " AND tasks.category LIKE ?"
+        params.append(f"%{filters['category']}%")
+    tags = split_tags(filters.get("tags", "").replace("|", ","))
+    if tags:
+        # tags=a,b needs every listed tag, tags=a|b any of them.
+        any_tag = "|" in filters["tags"]
+        placeholders = ", ".join("?" for _ in tags)
+        query += f" AND tasks.id IN (SELECT task_id FROM task_tags WHERE user_id=? AND tag IN ({placeholders})"
+        params.append(user_id)
+        params.extend(tags)
+        if any_tag:
+            query += ")"
+        else:
+            query += " GROUP BY task_id HAVING COUNT(*)=?)"
+            params.append(len(tags))
+    status = filters.get("status") or ("all" if filters.get("show_completed") == "1" else "open")
+    if status == "open":
+        query += " AND tasks.completed_at IS NULL"
+    elif status == "done":
+        query += " AND tasks.completed_at IS NOT NULL"
+    ranged = False
+    for key, condition in RANGE_FILTERS.items():
+        if filters.get(key) is not None:
+            query += f" AND {condition}"
+            params.append(filters[key])
+            ranged = True
+
+    if limit is None:
+        query += " ORDER BY tasks.id"
+        return query, tuple(params)
+
+    # Left alone, the planner pages through the user's whole history in id
+    # order to skip sorting. The unary + keeps the (user_id, id) index out of
+    # it, so a date range is answered from its own index and only the rows in
+    # range get sorted.
+    id_column = "+tasks.id" if ranged else "tasks.id"
+    if before is not None:
+        query += f" AND {id_column} < ? ORDER BY {id_column} DESC"
+        params.append(before)
+    else:
+        if after is not None:
+            query += f" AND {id_column} > ?"
+            params.append(after)
+        query += f" ORDER BY {id_column}"
+    query += " LIMIT ?"
+    params.append(limit)
+    return query, tuple(params)
+
+
+ALL_TASKS_QUERY = f"SELECT {TASK_COLUMNS} FROM tasks WHERE user_id=? ORDER BY id"
+
+
+@asynccontextmanager
+async def _writing(user_id: int):
+    """The pool's writer, for changes to user_id's tasks. Drops the user's cached pages once committed."""
+    async with get_pool().writer() as conn:
+        yield conn
+    cache.pages.invalidate(user_id)
+
+
+async def add_task(user_id: int, task: str, who: str, category: str, tags: str, created_at: int) -> int:
+    """Insert a new task and return its id."""
+    (task_id,) = await add_tasks(user_id, [(task, who, category, tags)], created_at)
+    return task_id
+
+
+async def add_tasks(user_id: int, items: list, created_at: int) -> list:
+    """
+    Insert a batch of (task, who, category, tags) tuples in one transaction.
+    Returns the new ids, in the order of items.
+    """
+    async with _writing(user_id) as conn:
+        return await _insert_tasks(
+            conn, user_id, [(task, who, category, tags, created_at, None, None) for task, who, category, tags in items]
+        )
+
+
+async def import_tasks(user_id: int, rows: list, chunk_size: int = IMPORT_CHUNK_SIZE) -> int:
+    """
+    Insert (task, who, category, tags, created_at, updated_at, completed_at)
+    tuples in transactions of chunk_size rows, so a large import does not keep
+    other users' writes waiting. Returns the number of tasks inserted.
+    """
+    for start in range(0, len(rows), chunk_size):
+        async with _writing(user_id) as conn:
+            await _insert_tasks(conn, user_id, rows[start : start + chunk_size])
+    return len(rows)
+
+
+async def _insert_tasks(conn, user_id: int, rows: list) -> list:
+    """Insert full task rows, their tags and full-text entries. Returns the new ids, in order."""
+    await conn.execute("INSERT INTO bulk_insert (active) VALUES (1)")
+    await conn.executemany(
+        "INSERT INTO tasks (user_id, task, who, category, tags, created_at, updated_at, completed_at)"
+        " VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+        [(user_id, *row) for row in rows],
+    )
+    # All writes go through this one connection under the write lock, so
+    # the batch got consecutive ids ending at the last one inserted.
+    async with conn.execute("SELECT last_insert_rowid()") as cursor:
+        (last_id,) = await cursor.fetchone()
+    first_id = last_id - len(rows) + 1
+    task_ids = list(range(first_id, last_id + 1))
+    # The tags go in while the per-row tag trigger stands aside too, so
+    # STATS_BULK_UPSERT counts them along with the rest.
+    await conn.executemany(
+        "INSERT OR IGNORE INTO task_tags (task_id, user_id, tag) VALUES (?, ?, ?)",
+        [(task_id, user_id, tag) for task_id, row in zip(task_ids, rows) for tag in split_tags(row[3])],
+    )
+    await conn.execute(
+        "INSERT INTO tasks_fts (rowid, task) SELECT id, task FROM tasks WHERE id BETWEEN ? AND ?",
+        (first_id, last_id),
+    )
+    await conn.execute(STATS_BULK_UPSERT, (first_id, last_id) * 5)
+    await conn.execute("DELETE FROM bulk_insert")
+    return task_ids
+
+
+# user_stats counts of the tasks with ids in a range, added in one statement
+# for rows inserted while the per-row triggers stand aside.
+STATS_BULK_UPSERT = """
+INSERT INTO user_stats (user_id, dimension, value, open, done)
+SELECT user_id, 'status', '', SUM(completed_at IS NULL), SUM(completed_at IS NOT NULL)
+FROM tasks WHERE id BETWEEN ? AND ? GROUP BY user_id
+UNION ALL
+SELECT user_id, 'category', COALESCE(category, ''), SUM(completed_at IS NULL), SUM(completed_at IS NOT NULL)
+FROM tasks WHERE id BETWEEN ? AND ? GROUP BY user_id, COALESCE(category, '') COLLATE NOCASE
+UNION ALL
+SELECT user_id, 'who', COALESCE(who, ''), SUM(completed_at IS NULL), SUM(completed_at IS NOT NULL)
+FROM tasks WHERE id BETWEEN ? AND ? GROUP BY user_id, COALESCE(who, '') COLLATE NOCASE
+UNION ALL
+SELECT task_tags.user_id, 'tag', tag, SUM(completed_at IS NULL), SUM(completed_at IS NOT NULL)
+FROM task_tags JOIN tasks ON tasks.id = task_tags.task_id
+WHERE task_tags.task_id BETWEEN ? AND ? GROUP BY task_tags.user_id, tag
+UNION ALL
+SELECT user_id, 'week', date(completed_at, 'unixepoch', 'weekday 0', '-6 days'), 0, COUNT(*)
+FROM tasks WHERE id BETWEEN ? AND ? AND completed_at IS NOT NULL GROUP BY user_id, 3
+ON CONFLICT (user_id, dimension, value) DO UPDATE SET open = open + excluded.open, done = done + excluded.done
+"""
+
+
+async def _insert_tags(conn, user_id: int, task_id: int, tags: str):
+    await conn.executemany(
+        "INSERT OR IGNORE INTO task_tags (task_id, user_id, tag) VALUES (?, ?, ?)",
+        [(task_id, user_id, tag) for tag in split_tags(tags)],
+    )
+
+
+# Per-task outcomes of complete_tasks()
+COMPLETED = "completed"
+ALREADY_COMPLETED = "already completed"
+NOT_FOUND = "not found"
+
+
+async def complete_task(user_id: int, task_id: int, completed_at: int) -> bool:
+    """Mark an open task as completed. Returns False if nothing matched."""
+    results = await complete_tasks(user_id, [task_id], completed_at)
+    return results[task_id] == COMPLETED
+
+
+async def complete_tasks(user_id: int, task_ids: list, completed_at: int) -> dict:
+    """
+    Mark a batch of tasks as completed in one transaction. Returns a dict
+    mapping each task id to COMPLETED, ALREADY_COMPLETED or NOT_FOUND.
+    """
+    async with _writing(user_id) as conn:
+        # The ids travel as one JSON parameter, so the statement text is the
+        # same for every batch size and stays in the statement cache.
+        async with conn.execute(
+            "SELECT id, completed_at FROM tasks WHERE user_id=? AND id IN (SELECT value FROM json_each(?))",
+            (user_id, json.dumps(list(task_ids))),
+        ) as cursor:
+            found = dict(await cursor.fetchall())
+        results = {}
+        for task_id in task_ids:
+            if task_id not in found:
+                results[task_id] = NOT_FOUND
+            elif found[task_id] is not None:
+                results[task_id] = ALREADY_COMPLETED
+            else:
+                results[task_id] = COMPLETED
+        await conn.executemany(
+            "UPDATE tasks SET completed_at=? WHERE id=? AND user_id=? AND completed_at IS NULL",
+            [(completed_at, task_id, user_id) for task_id, result in results.items() if result == COMPLETED],
+        )
+        return results
+
+
+async def update_task(user_id: int, task_id: int, fields: dict) -> bool:
+    """
+    Update the given columns of a task. `fields` maps column name to new value;
+    callers are responsible for only passing known column names.
+    """
+    # Sorting keeps the generated SQL stable for a given set of columns, so it
+    # hits the statement cache no matter which order the user typed them in.
+    columns = sorted(fields)
+    assignments = ", ".join(f"{k}=?" for k in columns)
+    values = [fields[k] for k in columns] + [task_id, user_id]
+    async with _writing(user_id) as conn:
+        cursor = await conn.execute(
+            f"UPDATE tasks SET {assignments} WHERE id=? AND user_id=?",
+            tuple(values),
+        )
+        if cursor.rowcount == 0:
+            return False
+        if "tags" in fields:
+            await conn.execute("DELETE FROM task_tags WHERE task_id=?", (task_id,))
+            await _insert_tags(conn, user_id, task_id, fields["tags"])
+        return True
+
+
+async def delete_task(user_id: int, task_id: int) -> bool:
+    async with _writing(user_id) as conn:
+        cursor = await conn.execute("DELETE FROM tasks WHERE id=? AND user_id=?", (task_id, user_id))
+        return cursor.rowcount > 0
+
+
+async def set_timezone(user_id: int, timezone: str):
+    """Store the timezone user_id's times are shown in. Callers validate the name."""
+    async with _writing(user_id) as conn:
+        await conn.execute(
+            "INSERT INTO user_settings (user_id, timezone) VALUES (?, ?)"
+            " ON CONFLICT (user_id) DO UPDATE SET timezone=excluded.timezone",
+            (user_id, timezone),
+        )
+
+
+async def fetch_timezone(user_id: int) -> str:
+    """The timezone user_id's times are shown in."""
+    async with get_pool().reader() as conn:
+        async with conn.execute("SELECT timezone FROM user_settings WHERE user_id=?", (user_id,)) as cursor:
+            row = await cursor.fetchone()
+    return row[0] if row and row[0] else timeutil.DEFAULT_TIMEZONE
+
+
+async def _select_tasks(user_id: int, filters: dict, **kwargs) -> list:
+    async with get_pool().reader() as conn:
+        query, params = build_task_query(user_id, filters, **kwargs)
+        try:
+            async with conn.execute(query, params) as cursor:
+                rows = await cursor.fetchall()
+        except sqlite3.OperationalError as error:
+            if not is_search_syntax_error(error, filters.get("task") or ""):
+                raise
+            # Malformed search syntax; treat the text as a plain substring.
+            query, params = build_task_query(user_id, filters, full_text=False, **kwargs)
+            async with conn.execute(query, params) as cursor:
+                rows = await cursor.fetchall()
+    metrics.record_rows(len(rows))
+    return rows
+
+
+async def fetch_tasks(user_id: int, filters: dict) -> list:
+    """Return the task rows of user_id matching the /list filters dict."""
+    return await _select_tasks(user_id, filters)
+
+
+async def fetch_task_page(
+    user_id: int, filters: dict, after: int = None, before: int = None, limit: int = PAGE_SIZE
+):
+    """
+    Return one page of the /list results as (rows, has_more), rows in id order.
+
+    Pages are addressed by keyset cursors rather than offsets: pass the last
+    id of the current page as `after` for the next page, or its first id as
+    `before` for the previous one. has_more tells whether more rows exist
+    beyond this page in the direction of travel.
+    """
+    rows = await _select_tasks(user_id, filters, after=after, before=before, limit=limit + 1)
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if before is not None:
+        rows.reverse()
+    return rows, has_more
+
+
+async def fetch_stats(user_id: int) -> dict:
+    """
+    Task counts of user_id from the user_stats aggregates: a dict mapping each
+    dimension (status, category, who, tag, week) to (value, open, done) rows.
+    """
+    stats = {}
+    async with get_pool().reader() as conn:
+        async with conn.execute(
+            "SELECT dimension, value, open, done FROM user_stats WHERE user_id=? AND (open > 0 OR done > 0)",
+            (user_id,),
+        ) as cursor:
+            async for dimension, value, open_count, done_count in cursor:
+                stats.setdefault(dimension, []).append((value, open_count, done_count))
+    return stats
+
+
+async def fetch_all_tasks(user_id: int) -> list:
+    """Return every task row of user_id, completed ones included."""
+    async with get_pool().reader() as conn:
+        async with conn.execute(ALL_TASKS_QUERY, (user_id,)) as cursor:
+            rows = await cursor.fetchall()
+    metrics.record_rows(len(rows))
+    return rows
+
+
+async def iter_all_tasks(user_id: int):
+    """Yield every task row of user_id straight from the cursor, in id order."""
+    async with get_pool().reader() as conn:
+        count = 0
+        async with conn.execute(ALL_TASKS_QUERY, (user_id,)) as cursor:
+            async for row in cursor:
+                count += 1
+                yield row
+    metrics.record_rows(count)
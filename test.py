@@ -1,5 +1,107 @@
+import asyncio
+import contextlib
+import io
+import json
+import logging
+import os
+import random
+import re
+import sqlite3
+import tempfile
+import threading
+import time
 import unittest
-from tbot import parse_add_command
+from datetime import timedelta
+
+from telegram.error import RetryAfter
+
+import cache
+import concurrency
+import export
+import fakes
+import importer
+import logs
+import metrics
+import profiling
+import ratelimit
+import repository
+import storage
+import tbot
+import timeutil
+import webhook
+from tbot import parse_add_command, parse_params
+
+
+def ts(text: str) -> int:
+    return timeutil.parse_timestamp(text, "UTC")
+
+
+class TestParseParams(unittest.TestCase):
+    def test_download_format(self):
+        self.assertEqual(parse_params("format=csv.gz"), {"format": "csv.gz"})
+
+    def test_unknown_keys_end_the_previous_value(self):
+        self.assertEqual(parse_params("who=Bob Smith foo=bar tags=a"), {"who": "Bob Smith", "tags": "a"})
+
+    def test_equals_inside_a_value(self):
+        self.assertEqual(parse_params("tags=a,b=c who=Bob"), {"tags": "a,b=c", "who": "Bob"})
+
+    def test_quoted_values(self):
+        self.assertEqual(
+            parse_params("task=\"who=me\" who = 'Bob Smith' category=Work"),
+            {"task": "who=me", "who": "Bob Smith", "category": "Work"},
+        )
+
+    def test_text_after_a_closing_quote_stays_in_the_value(self):
+        self.assertEqual(parse_params('who="Alice" and Bob tags=a'), {"who": "Alice and Bob", "tags": "a"})
+        self.assertEqual(parse_params("who=' Alice ' tags=a"), {"who": " Alice ", "tags": "a"})
+        self.assertEqual(parse_add_command('Call who="Al=1" later'), ("Call", {"who": "Al=1 later"}))
+
+    def test_comparison_keys(self):
+        self.assertEqual(
+            parse_params("created>=2024-01-01 created < 7d completed_since=today status=done"),
+            {"created>=": "2024-01-01", "created<": "7d", "completed_since": "today", "status": "done"},
+        )
+        # Other comparisons are plain text.
+        self.assertEqual(parse_params("task=a < b who>=x tags=y"), {"task": "a < b who>=x", "tags": "y"})
+
+    def test_unterminated_quote_is_literal(self):
+        self.assertEqual(parse_params('who="Bob tags=a'), {"who": '"Bob', "tags": "a"})
+
+    def test_adversarial_input_is_linear(self):
+        start = time.perf_counter()
+        parse_params("task=a" + " " * 200000 + "x")
+        parse_params("who=" + "a=" * 100000)
+        parse_add_command("x" * 200000 + " who" + " " * 100000)
+        self.assertLess(time.perf_counter() - start, 2)
+
+
+class TestListFilters(unittest.TestCase):
+    def test_dates_become_epoch_seconds_in_the_users_timezone(self):
+        params = {"created>=": "2024-01-01", "created<": "2024-02-01 12:00", "who": "Bob"}
+        filters = tbot.list_filters(params, "Europe/Berlin")
+        self.assertEqual(
+            filters,
+            {"created_from": ts("2023-12-31 23:00:00"), "created_until": ts("2024-02-01 11:00:00"), "who": "Bob"},
+        )
+
+    def test_completed_since_lists_done_tasks(self):
+        filters = tbot.list_filters({"completed_since": "2024-01-01"}, "UTC")
+        self.assertEqual(filters["status"], "done")
+        self.assertEqual(tbot.list_filters({"completed_since": "2024-01-01", "status": "ALL"}, "UTC")["status"], "all")
+
+    def test_relative_dates(self):
+        now = ts("2024-03-10 15:30:00")
+        self.assertEqual(timeutil.parse_date("today", "UTC", now), ts("2024-03-10 00:00:00"))
+        self.assertEqual(timeutil.parse_date("yesterday", "UTC", now), ts("2024-03-09 00:00:00"))
+        self.assertEqual(timeutil.parse_date("1w", "UTC", now), ts("2024-03-03 00:00:00"))
+        self.assertEqual(timeutil.parse_date("2d", "America/New_York", now), ts("2024-03-08 05:00:00"))
+
+    def test_invalid_values(self):
+        for params in ({"created>=": "last week"}, {"completed_since": "99999999999d"}, {"status": "pending"}):
+            with self.subTest(params=params), self.assertRaises(ValueError):
+                tbot.list_filters(params, "UTC")
+
 
 class TestParseAddCommand(unittest.TestCase):
     def test_only_task(self):
@@ -20,11 +122,1465 @@ class TestParseAddCommand(unittest.TestCase):
         self.assertEqual(task, "Buy milk, eggs, bread")
         self.assertEqual(params, {"who": "Alice", "tags": "grocery,food"})
 
+    def test_quoted_value_can_contain_keys(self):
+        task, params = parse_add_command('Read "who=" chapter who="Alice Smith" tags=books')
+        self.assertEqual(task, 'Read "who=" chapter')
+        self.assertEqual(params, {"who": "Alice Smith", "tags": "books"})
+
     def test_task_with_spaces_around_equals(self):
         text = "Do homework who = Alice category = School tags = urgent,homework"
         task, params = parse_add_command(text)
         self.assertEqual(task, "Do homework")
         self.assertEqual(params, {"who": "Alice", "category": "School", "tags": "urgent,homework"})
 
+
+class TestParseTaskIds(unittest.TestCase):
+    def test_ids_and_ranges(self):
+        self.assertEqual(tbot.parse_task_ids(["3", "5", "7-9"]), [3, 5, 7, 8, 9])
+
+    def test_commas_and_duplicates(self):
+        self.assertEqual(tbot.parse_task_ids(["3,5", "4-6", "3"]), [3, 5, 4, 6])
+
+    def test_rejects_malformed_ids(self):
+        for args in (["x"], ["3-"], ["-3"], ["9-7"], ["1-2-3"], ["1-1000"]):
+            with self.subTest(args=args), self.assertRaises(ValueError):
+                tbot.parse_task_ids(args)
+
+    def test_rejects_too_many_ids(self):
+        with self.assertRaises(ValueError):
+            tbot.parse_task_ids(["1-60", "100-160"])
+
+
+class DatabaseTestCase(unittest.IsolatedAsyncioTestCase):
+    """A fresh tasks.db in a temporary directory, opened as the storage pool unless open_storage is False."""
+
+    readers = 1
+    open_storage = True
+
+    async def asyncSetUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, "tasks.db")
+        if self.open_storage:
+            await storage.open_pool(self.path, readers=self.readers)
+
+    async def asyncTearDown(self):
+        await storage.close_pool()
+        self.tmpdir.cleanup()
+
+
+class TestStorage(DatabaseTestCase):
+    readers = 2
+
+    async def test_add_complete_and_list(self):
+        task_id = await storage.add_task(1, "Buy milk", "Alice", "Home", "grocery", ts("2024-01-01 10:00:00"))
+        await storage.add_task(2, "Other user", "", "", "", ts("2024-01-01 10:00:00"))
+        rows = await storage.fetch_tasks(1, {})
+        self.assertEqual([r[0] for r in rows], [task_id])
+
+        self.assertTrue(await storage.complete_task(1, task_id, ts("2024-01-02 10:00:00")))
+        self.assertFalse(await storage.complete_task(1, task_id, ts("2024-01-02 10:00:00")))
+        self.assertEqual(await storage.fetch_tasks(1, {}), [])
+        self.assertEqual(len(await storage.fetch_tasks(1, {"show_completed": "1"})), 1)
+
+    async def test_batch_add_and_complete(self):
+        ids = await storage.add_tasks(
+            1, [("One", "", "", "a"), ("Two", "Bob", "", "a,b"), ("Three", "", "", "")], ts("2024-01-01 10:00:00")
+        )
+        other = await storage.add_task(2, "Other user", "", "", "", ts("2024-01-01 10:00:00"))
+        rows = await storage.fetch_tasks(1, {})
+        self.assertEqual([(r[0], r[1]) for r in rows], list(zip(ids, ["One", "Two", "Three"])))
+        self.assertEqual([r[0] for r in await storage.fetch_tasks(1, {"tags": "b"})], [ids[1]])
+
+        await storage.complete_task(1, ids[0], ts("2024-01-02 10:00:00"))
+        results = await storage.complete_tasks(1, [ids[0], ids[1], other, 999], ts("2024-01-02 10:00:00"))
+        self.assertEqual(
+            results,
+            {
+                ids[0]: storage.ALREADY_COMPLETED,
+                ids[1]: storage.COMPLETED,
+                other: storage.NOT_FOUND,
+                999: storage.NOT_FOUND,
+            },
+        )
+        self.assertEqual([r[0] for r in await storage.fetch_tasks(1, {})], [ids[2]])
+        self.assertEqual(len(await storage.fetch_tasks(2, {})), 1)
+
+    async def test_batch_commands(self):
+        update, context = fakes.command(1, "/add Buy milk tags=grocery\n\n  who=Bob\nCall mum who=Me")
+        await tbot.add(update, context)
+        self.assertEqual(
+            update.message.replies[-1],
+            "Added 2 tasks:\n1. Buy milk\n2. Call mum\nSkipped line(s) 3: empty description",
+        )
+        rows = await storage.fetch_tasks(1, {})
+        self.assertEqual([(r[1], r[2], r[4]) for r in rows], [("Buy milk", "", "grocery"), ("Call mum", "Me", "")])
+
+        update, context = fakes.command(1, "/done 1 1-3")
+        await tbot.done(update, context)
+        self.assertEqual(update.message.replies[-1], "Completed: 1, 2\nNot found: 3")
+
+        update, context = fakes.command(1, "/done 2")
+        await tbot.done(update, context)
+        self.assertEqual(update.message.replies[-1], "Task not found or already completed")
+
+    async def test_status_and_date_range_filters(self):
+        old = await storage.add_task(1, "Old", "", "", "", ts("2024-01-01 10:00:00"))
+        new = await storage.add_task(1, "New", "", "", "", ts("2024-02-01 10:00:00"))
+        done_early = await storage.add_task(1, "Done early", "", "", "", ts("2024-01-01 10:00:00"))
+        done_late = await storage.add_task(1, "Done late", "", "", "", ts("2024-01-01 10:00:00"))
+        await storage.complete_task(1, done_early, ts("2024-01-05 10:00:00"))
+        await storage.complete_task(1, done_late, ts("2024-02-05 10:00:00"))
+
+        async def ids(filters, **kwargs):
+            rows, _ = await storage.fetch_task_page(1, filters, **kwargs)
+            return [r[0] for r in rows]
+
+        self.assertEqual(await ids({}), [old, new])
+        self.assertEqual(await ids({"status": "done"}), [done_early, done_late])
+        self.assertEqual(await ids({"status": "all"}), [old, new, done_early, done_late])
+        self.assertEqual(await ids({"status": "done", "completed_from": ts("2024-02-01 00:00:00")}), [done_late])
+        self.assertEqual(await ids({"created_from": ts("2024-01-15 00:00:00")}), [new])
+        all_january = {"status": "all", "created_until": ts("2024-02-01 00:00:00")}
+        self.assertEqual(await ids(all_january), [old, done_early, done_late])
+        self.assertEqual(await ids(all_january, after=old, limit=1), [done_early])
+        self.assertEqual(await ids(all_january, before=done_late, limit=1), [done_early])
+
+    async def test_update_and_delete_are_scoped_to_user(self):
+        task_id = await storage.add_task(1, "Write report", "", "Work", "", ts("2024-01-01 10:00:00"))
+        self.assertFalse(await storage.update_task(2, task_id, {"who": "Mallory"}))
+        self.assertTrue(await storage.update_task(1, task_id, {"who": "Bob"}))
+        rows = await storage.fetch_tasks(1, {"who": "Bob"})
+        self.assertEqual(len(rows), 1)
+
+        self.assertFalse(await storage.delete_task(2, task_id))
+        self.assertTrue(await storage.delete_task(1, task_id))
+        self.assertEqual(await storage.fetch_all_tasks(1), [])
+
+    async def test_pool_uses_wal_and_serves_concurrent_traffic(self):
+        pool = storage.get_pool()
+        async with pool.reader() as conn:
+            async with conn.execute("PRAGMA journal_mode") as cursor:
+                self.assertEqual((await cursor.fetchone())[0], "wal")
+
+        async def writer(n):
+            for i in range(20):
+                await storage.add_task(n, f"task {i}", "", "", "", ts("2024-01-01 10:00:00"))
+
+        async def reader(n):
+            for _ in range(20):
+                await storage.fetch_tasks(n, {})
+
+        await asyncio.gather(*(writer(n) for n in range(3)), *(reader(n) for n in range(3)))
+        for n in range(3):
+            self.assertEqual(len(await storage.fetch_tasks(n, {})), 20)
+
+    async def test_failed_write_is_rolled_back(self):
+        with self.assertRaises(RuntimeError):
+            async with storage.get_pool().writer() as conn:
+                await conn.execute(
+                    "INSERT INTO tasks (user_id, task, created_at) VALUES (?, ?, ?)", (1, "x", ts("2024-01-01 10:00:00"))
+                )
+                raise RuntimeError("boom")
+        self.assertEqual(await storage.fetch_all_tasks(1), [])
+
+    async def test_migrations_are_recorded_and_idempotent(self):
+        await storage.open_pool(storage.get_pool().path, readers=1)
+        async with storage.get_pool().reader() as conn:
+            async with conn.execute("PRAGMA user_version") as cursor:
+                self.assertEqual((await cursor.fetchone())[0], len(storage.MIGRATIONS))
+
+
+class TestTimestamps(DatabaseTestCase):
+    # Tests build a database of an older schema first.
+    open_storage = False
+
+    async def test_migration_converts_local_text_to_epoch(self):
+        conn = sqlite3.connect(self.path)
+        for script in storage.MIGRATIONS[:6]:
+            conn.executescript(script)
+        conn.executemany(
+            "INSERT INTO tasks (user_id, task, tags, created_at, completed_at) VALUES (1, ?, 'x', ?, ?)",
+            [("Old", "2024-01-01 10:00:00", "2024-07-01 12:30:00"), ("Deleted", "2024-01-01 10:00:00", None)],
+        )
+        conn.execute("INSERT INTO task_tags (task_id, user_id, tag) VALUES (1, 1, 'x')")
+        conn.execute("DELETE FROM tasks WHERE task='Deleted'")
+        conn.execute("PRAGMA user_version=6")
+        conn.commit()
+        conn.close()
+
+        # Legacy values were written in the server's local time.
+        old_tz = os.environ.get("TZ")
+        os.environ["TZ"] = "Europe/Berlin"
+        time.tzset()
+        try:
+            await storage.open_pool(self.path, readers=1)
+        finally:
+            if old_tz is None:
+                del os.environ["TZ"]
+            else:
+                os.environ["TZ"] = old_tz
+            time.tzset()
+
+        rows = await storage.fetch_all_tasks(1)
+        self.assertEqual(rows[0][5:], (ts("2024-01-01 09:00:00"), None, ts("2024-07-01 10:30:00")))
+        rows = await storage.fetch_tasks(1, {"tags": "x", "task": "old", "show_completed": "1"})
+        self.assertEqual([r[1] for r in rows], ["Old"])
+        # Ids of deleted tasks are not handed out again.
+        self.assertEqual(await storage.add_task(1, "New", "", "", "", timeutil.now()), 3)
+
+    async def test_times_are_shown_in_the_users_timezone(self):
+        await storage.open_pool(self.path, readers=1)
+        await storage.add_task(1, "Task", "", "", "", ts("2024-01-01 10:00:00"))
+        update, context = fakes.command(1, "/timezone europe/berlin")
+        await tbot.set_timezone(update, context)
+        self.assertEqual(update.message.replies[-1], "🕒 Times are now shown in Europe/Berlin.")
+        update, context = fakes.command(1, "/timezone Mars/Olympus")
+        await tbot.set_timezone(update, context)
+        self.assertTrue(update.message.replies[-1].startswith("Unknown timezone"))
+
+        message, _ = await tbot.format_tasks(1, {})
+        self.assertIn("created: 2024-01-01 11:00:00", message)
+        data, _ = export.export_tasks(self.path, 1, "jsonl", await storage.fetch_timezone(1))
+        self.assertEqual(json.loads(data)["created_at"], "2024-01-01 11:00:00")
+        tasks, _, _ = importer.parse_rows([["Task", "Created At"], ["Task", "2024-01-01 11:00:00"]], 0, "Europe/Berlin")
+        self.assertEqual(tasks[0][4], ts("2024-01-01 10:00:00"))
+        self.assertEqual(await storage.fetch_timezone(2), timeutil.DEFAULT_TIMEZONE)
+
+
+class TestStats(DatabaseTestCase):
+
+    async def recomputed(self, user_id):
+        """What fetch_stats should return, counted from the tasks themselves."""
+        counts = {}
+
+        def count(dimension, value, done):
+            key = (dimension, value.lower())
+            open_count, done_count = counts.get(key, (0, 0))
+            counts[key] = (open_count + (not done), done_count + done)
+
+        for row in await storage.fetch_all_tasks(user_id):
+            done = row[7] is not None
+            count("status", "", done)
+            count("category", row[3] or "", done)
+            count("who", row[2] or "", done)
+            for tag in storage.split_tags(row[4]):
+                count("tag", tag, done)
+            if done:
+                week = time.strftime("%Y-%m-%d", time.gmtime(row[7] - (time.gmtime(row[7]).tm_wday * 86400)))
+                counts[("week", week)] = (0, counts.get(("week", week), (0, 0))[1] + 1)
+        return {key: value for key, value in counts.items() if value != (0, 0)}
+
+    async def stored(self, user_id):
+        stats = await storage.fetch_stats(user_id)
+        return {(d, value.lower()): (o, c) for d, rows in stats.items() for value, o, c in rows}
+
+    async def test_aggregates_follow_every_write_path(self):
+        rng = random.Random(3)
+        day = ts("2024-01-01 10:00:00")
+        await storage.import_tasks(1, [("Imported", "Ann", "Work", "x,Y", day, None, day + 86400 * 9)])
+        for step in range(300):
+            user_id = rng.randint(1, 2)
+            ids = [r[0] for r in await storage.fetch_all_tasks(user_id)]
+            action = rng.random()
+            category = rng.choice(["Work", "work", "Home", ""])
+            tags = ",".join(rng.sample(["a", "b", "C", "c"], rng.randint(0, 2)))
+            if action < 0.35 or not ids:
+                items = [(f"task {step}", rng.choice(["Ann", "Bob", ""]), category, tags)] * rng.randint(1, 3)
+                await storage.add_tasks(user_id, items, day)
+            elif action < 0.6:
+                chosen = rng.sample(ids, min(len(ids), 3))
+                await storage.complete_tasks(user_id, chosen, day + 86400 * rng.randint(0, 30))
+            elif action < 0.8:
+                fields = rng.choice([{"category": category}, {"tags": tags}, {"who": "Cy", "tags": tags}])
+                await storage.update_task(user_id, rng.choice(ids), fields)
+            else:
+                await storage.delete_task(user_id, rng.choice(ids))
+        for user_id in (1, 2):
+            self.assertEqual(await self.stored(user_id), await self.recomputed(user_id))
+
+    async def test_bulk_import_counts_tags_in_one_go(self):
+        # Without the per-row trigger, the counts can only come from STATS_BULK_UPSERT.
+        async with storage.get_pool().writer() as conn:
+            await conn.execute("DROP TRIGGER user_stats_tag_insert")
+        day = ts("2024-01-01 10:00:00")
+        rows = [
+            ("One", "Ann", "Work", "x,Y", day, None, None),
+            ("Two", "Ann", "Work", "x, x", day, None, day + 86400),
+            ("Three", "", "", "y", day, None, None),
+            ("Four", "", "", "", day, None, None),
+        ]
+        await storage.import_tasks(1, rows, chunk_size=3)
+        stats = await storage.fetch_stats(1)
+        self.assertEqual(sorted((value.lower(), o, c) for value, o, c in stats["tag"]), [("x", 1, 1), ("y", 2, 0)])
+        self.assertEqual(await self.stored(1), await self.recomputed(1))
+
+    async def test_migration_backfills_existing_tasks(self):
+        path = storage.get_pool().path
+        await storage.close_pool()
+        os.remove(path)
+        conn = sqlite3.connect(path)
+        for script in storage.MIGRATIONS[:8]:
+            conn.executescript(script)
+        conn.executemany(
+            "INSERT INTO tasks (user_id, task, who, category, tags, created_at, completed_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            [
+                (1, "Essay", "Ann", "School", "homework", ts("2024-01-01 10:00:00"), None),
+                (1, "Report", "", "school", "work,urgent", ts("2024-01-01 10:00:00"), ts("2024-01-10 10:00:00")),
+                (2, "Other", "", "", "", ts("2024-01-01 10:00:00"), None),
+            ],
+        )
+        conn.executemany(
+            "INSERT INTO task_tags (task_id, user_id, tag) VALUES (?, 1, ?)", [(1, "homework"), (2, "work"), (2, "urgent")]
+        )
+        conn.execute("PRAGMA user_version=8")
+        conn.commit()
+        conn.close()
+
+        await storage.open_pool(path, readers=1)
+        for user_id in (1, 2):
+            self.assertEqual(await self.stored(user_id), await self.recomputed(user_id))
+
+    async def test_stats_command(self):
+        await storage.add_task(1, "Essay", "Ann", "School", "homework", ts("2024-01-01 10:00:00"))
+        done = await storage.add_task(1, "Report", "", "Work", "work, urgent", ts("2024-01-01 10:00:00"))
+        await storage.complete_task(1, done, ts("2024-01-10 10:00:00"))
+
+        update, context = fakes.command(1, "/stats")
+        await tbot.stats_command(update, context)
+        reply = update.message.replies[-1]
+        self.assertTrue(reply.startswith("📊 <b>1</b> open, <b>1</b> done"), reply)
+        self.assertIn("School: 1 / 0", reply)
+        self.assertIn("urgent: 0 / 1", reply)
+        self.assertIn("2024-01-08: 1", reply)
+
+        update, context = fakes.command(2, "/stats")
+        await tbot.stats_command(update, context)
+        self.assertEqual(update.message.replies[-1], "No tasks yet.")
+
+
+class TestFullTextSearch(DatabaseTestCase):
+    async def asyncSetUp(self):
+        await super().asyncSetUp()
+        for text in ["Buy milk and eggs", "Milk the cows", "Buy bread", "Call mom about milk milk"]:
+            await storage.add_task(1, text, "", "", "", ts("2024-01-01 10:00:00"))
+        await storage.add_task(2, "Buy milk", "", "", "", ts("2024-01-01 10:00:00"))
+
+    async def search(self, text):
+        return [r[1] for r in await storage.fetch_tasks(1, {"task": text})]
+
+    async def test_plain_words_match_as_prefixes(self):
+        self.assertEqual(sorted(await self.search("mil")), ["Buy milk and eggs", "Call mom about milk milk", "Milk the cows"])
+        self.assertEqual(await self.search("buy bre"), ["Buy bread"])
+
+    async def test_phrase_and_boolean_queries(self):
+        self.assertEqual(await self.search('"milk the"'), ["Milk the cows"])
+        self.assertEqual(sorted(await self.search("bread OR cows")), ["Buy bread", "Milk the cows"])
+        self.assertEqual(await self.search("buy NOT milk"), ["Buy bread"])
+
+    async def test_results_come_in_id_order(self):
+        rows = await storage.fetch_tasks(1, {"task": "milk"})
+        self.assertEqual([r[0] for r in rows], sorted(r[0] for r in rows))
+
+    async def test_malformed_query_falls_back_to_substring(self):
+        self.assertEqual(await self.search("milk AND"), ["Buy milk and eggs"])
+        self.assertEqual(await self.search("(bread"), [])
+        self.assertEqual(await self.search('"milk the'), [])
+        self.assertEqual(await self.search("call OR e-mail"), [])
+
+    async def test_database_errors_are_not_taken_for_bad_syntax(self):
+        async with storage.get_pool().writer() as conn:
+            await conn.execute("DROP TABLE tasks_fts")
+        with self.assertRaisesRegex(sqlite3.OperationalError, "no such table"):
+            await self.search("milk")
+
+    async def test_index_follows_updates_and_deletes(self):
+        rows = await storage.fetch_tasks(1, {"task": "bread"})
+        task_id = rows[0][0]
+        await storage.update_task(1, task_id, {"task": "Buy butter"})
+        self.assertEqual(await self.search("bread"), [])
+        self.assertEqual(await self.search("butter"), ["Buy butter"])
+        await storage.delete_task(1, task_id)
+        self.assertEqual(await self.search("butter"), [])
+
+
+class TestTags(DatabaseTestCase):
+
+    async def tagged(self, tags, user_id=1):
+        return sorted(r[1] for r in await storage.fetch_tasks(user_id, {"tags": tags}))
+
+    async def test_exact_all_and_any_matching(self):
+        await storage.add_task(1, "Essay", "", "", "homework", ts("2024-01-01 10:00:00"))
+        await storage.add_task(1, "Report", "", "", "work, urgent", ts("2024-01-01 10:00:00"))
+        await storage.add_task(1, "Slides", "", "", "Work", ts("2024-01-01 10:00:00"))
+        await storage.add_task(2, "Other", "", "", "work", ts("2024-01-01 10:00:00"))
+
+        self.assertEqual(await self.tagged("work"), ["Report", "Slides"])
+        self.assertEqual(await self.tagged("work,urgent"), ["Report"])
+        self.assertEqual(await self.tagged("urgent|homework"), ["Essay", "Report"])
+        self.assertEqual(await self.tagged("home"), [])
+
+    async def test_update_and_delete_keep_tags_in_sync(self):
+        task_id = await storage.add_task(1, "Report", "", "", "work", ts("2024-01-01 10:00:00"))
+        await storage.update_task(1, task_id, {"tags": "urgent"})
+        self.assertEqual(await self.tagged("work"), [])
+        self.assertEqual(await self.tagged("urgent"), ["Report"])
+        await storage.delete_task(1, task_id)
+        async with storage.get_pool().reader() as conn:
+            async with conn.execute("SELECT COUNT(*) FROM task_tags") as cursor:
+                self.assertEqual((await cursor.fetchone())[0], 0)
+
+    async def test_migration_backfills_existing_rows(self):
+        await storage.close_pool()
+        os.remove(self.path)
+        conn = sqlite3.connect(self.path)
+        conn.executescript(storage.MIGRATIONS[0])
+        conn.execute(
+            "INSERT INTO tasks (user_id, task, tags, created_at) VALUES (1, 'Legacy', 'work, urgent,,work', '2024-01-01 10:00:00')"
+        )
+        conn.commit()
+        conn.close()
+
+        await storage.open_pool(self.path, readers=1)
+        self.assertEqual(await self.tagged("urgent,work"), ["Legacy"])
+        self.assertEqual(await self.tagged("urg"), [])
+
+
+class TestPagination(DatabaseTestCase):
+    async def asyncSetUp(self):
+        await super().asyncSetUp()
+        async with storage.get_pool().writer() as conn:
+            await conn.executemany(
+                "INSERT INTO tasks (user_id, task, created_at) VALUES (?, ?, ?)",
+                [(1, f"task {i}", ts("2024-01-01 10:00:00")) for i in range(1, 51)],
+            )
+
+    async def test_keyset_pages_forward_and_back(self):
+        rows, has_more = await storage.fetch_task_page(1, {}, limit=20)
+        self.assertEqual([r[0] for r in rows], list(range(1, 21)))
+        self.assertTrue(has_more)
+
+        rows, has_more = await storage.fetch_task_page(1, {}, after=40, limit=20)
+        self.assertEqual([r[0] for r in rows], list(range(41, 51)))
+        self.assertFalse(has_more)
+
+        rows, has_more = await storage.fetch_task_page(1, {}, before=41, limit=20)
+        self.assertEqual([r[0] for r in rows], list(range(21, 41)))
+        self.assertTrue(has_more)
+
+    async def test_navigation_buttons_carry_cursors(self):
+        message, markup = await tbot.format_tasks(1, {})
+        self.assertEqual(message.count("\n") + 1, storage.PAGE_SIZE)
+        self.assertEqual([b.callback_data for b in markup.inline_keyboard[0]], ["list:next:20"])
+
+        message, markup = await tbot.format_tasks(1, {}, after=20)
+        self.assertEqual([b.callback_data for b in markup.inline_keyboard[0]], ["list:prev:21", "list:next:40"])
+
+        message, markup = await tbot.format_tasks(1, {}, after=40)
+        self.assertEqual([b.callback_data for b in markup.inline_keyboard[0]], ["list:prev:41"])
+
+        message, markup = await tbot.format_tasks(1, {}, after=50)
+        self.assertEqual(message, "No more tasks.")
+
+    async def test_buttons_page_through_their_own_listing(self):
+        await storage.complete_tasks(1, list(range(1, 26)), ts("2024-01-02 10:00:00"))
+        user_data = {}
+        done_list, _ = fakes.command(1, "/list status=done")
+        await tbot.list_tasks(done_list, fakes.FakeContext(["status=done"], user_data))
+        await tbot.list_tasks(fakes.command(1, "/list")[0], fakes.FakeContext([], user_data))
+
+        query = fakes.FakeCallbackQuery(1, "list:next:20", done_list.message.sent[0])
+        await tbot.handle_list_page(fakes.FakeUpdate(callback_query=query), fakes.FakeContext([], user_data))
+        self.assertTrue(query.message.text.startswith("<b>21.</b>"))
+        self.assertEqual(query.message.text.count("\n"), 4)
+
+        stale = fakes.FakeCallbackQuery(1, "list:next:20")
+        await tbot.handle_list_page(fakes.FakeUpdate(callback_query=stale), fakes.FakeContext([], user_data))
+        self.assertEqual(stale.answers, [tbot.LISTING_EXPIRED])
+        self.assertEqual(stale.message.text, "")
+
+    def test_remembered_listings_are_bounded(self):
+        user_data = {}
+        for message_id in range(tbot.MAX_LISTINGS + 5):
+            tbot.remember_listing(user_data, message_id, {"who": str(message_id)})
+        self.assertEqual(list(user_data["list_filters"]), list(range(5, tbot.MAX_LISTINGS + 5)))
+
+    async def test_page_is_cut_to_telegram_message_limit(self):
+        await storage.update_task(1, 2, {"task": "x" * 5000})
+        await storage.update_task(1, 5, {"task": "y" * 5000})
+        message, markup = await tbot.format_tasks(1, {})
+        self.assertLessEqual(len(message), tbot.MAX_MESSAGE_LENGTH)
+        next_cursor = int(markup.inline_keyboard[0][-1].callback_data.split(":")[2])
+        self.assertLess(next_cursor, 20)
+        message, markup = await tbot.format_tasks(1, {}, after=next_cursor)
+        self.assertTrue(message.startswith(f"<b>{next_cursor + 1}.</b>"))
+
+    async def test_long_fields_of_a_single_task_fit_in_a_message(self):
+        row = ("Imported", "w" * 5000, "c" * 5000, "t" * 3000 + ",u", ts("2024-01-01 10:00:00"), None, None)
+        await storage.import_tasks(2, [row])
+        message, _ = await tbot.format_tasks(2, {})
+        self.assertLessEqual(len(message), tbot.MAX_MESSAGE_LENGTH)
+        self.assertIn("w" * tbot.FIELD_TEXT_LIMIT + "…", message)
+
+    async def test_repeated_listing_is_served_from_cache(self):
+        cache.pages.hits = cache.pages.misses = 0
+        first = await tbot.format_tasks(1, {})
+        self.assertEqual(await tbot.format_tasks(1, {}), first)
+        self.assertEqual((cache.pages.hits, cache.pages.misses), (1, 1))
+
+        await storage.complete_task(1, 1, ts("2024-01-02 10:00:00"))
+        message, _ = await tbot.format_tasks(1, {})
+        self.assertFalse(message.startswith("<b>1.</b>"))
+        self.assertEqual(cache.pages.misses, 2)
+
+
+class TestExport(DatabaseTestCase):
+
+    async def test_xlsx_contains_header_and_all_rows(self):
+        from openpyxl import load_workbook
+
+        await storage.add_task(1, "First", "Alice", "Work", "a,b", ts("2024-01-01 10:00:00"))
+        second = await storage.add_task(1, "Second", "", "", "", ts("2024-01-01 11:00:00"))
+        await storage.complete_task(1, second, ts("2024-01-02 10:00:00"))
+        await storage.add_task(2, "Not mine", "", "", "", ts("2024-01-01 10:00:00"))
+
+        data, count = await export.pool.run(export.export_tasks, storage.get_pool().path, 1)
+        self.assertEqual(count, 2)
+        ws = load_workbook(io.BytesIO(data), read_only=True)["Tasks"]
+        rows = list(ws.iter_rows(values_only=True))
+        self.assertEqual(list(rows[0]), export.HEADERS)
+        self.assertEqual([r[1] for r in rows[1:]], ["First", "Second"])
+        self.assertEqual(rows[2][7], "2024-01-02 10:00:00")
+
+    async def test_text_formats_round_trip(self):
+        import csv
+        import gzip
+        import json
+
+        await storage.add_task(1, 'Quote "this", please', "Alice", "", "a,b", ts("2024-01-01 10:00:00"))
+        path = storage.get_pool().path
+
+        data, count = export.export_tasks(path, 1, "csv")
+        rows = list(csv.reader(io.StringIO(data.decode("utf-8"))))
+        self.assertEqual(count, 1)
+        self.assertEqual(rows[0], export.HEADERS)
+        self.assertEqual(rows[1][1:5], ['Quote "this", please', "Alice", "", "a,b"])
+
+        data, _ = export.export_tasks(path, 1, "csv.gz")
+        self.assertEqual(list(csv.reader(io.StringIO(gzip.decompress(data).decode("utf-8")))), rows)
+
+        data, _ = export.export_tasks(path, 1, "jsonl")
+        record = json.loads(data.decode("utf-8").splitlines()[0])
+        self.assertEqual(record["task"], 'Quote "this", please')
+        self.assertIsNone(record["completed_at"])
+
+    async def test_empty_export_reports_no_rows(self):
+        _, count = await export.pool.run(export.export_tasks, storage.get_pool().path, 1)
+        self.assertEqual(count, 0)
+
+    async def test_pool_turns_away_requests_beyond_its_queue(self):
+        pool = export.ExportPool(workers=1, queue_size=1)
+        release = threading.Event()
+        jobs = [asyncio.ensure_future(pool.run(release.wait)) for _ in range(2)]
+        await asyncio.sleep(0)
+        with self.assertRaises(export.ExportQueueFull):
+            await pool.run(release.wait)
+        release.set()
+        await asyncio.gather(*jobs)
+        self.assertEqual(pool.pending, 0)
+
+    async def test_process_pool_builds_export(self):
+        await storage.add_task(1, "First", "", "", "", ts("2024-01-01 10:00:00"))
+        pool = export.ExportPool(workers=1)
+        pool.start()
+        try:
+            _, count = await pool.run(export.export_tasks, storage.get_pool().path, 1)
+        finally:
+            pool.shutdown()
+        self.assertEqual(count, 1)
+
+    async def test_stream_writes_rows_while_they_are_read(self):
+        produced = []
+        written = []
+
+        async def rows(fail=False):
+            for i in range(5 * export.STREAM_BATCH_SIZE):
+                # The reader never gets far ahead of the writer.
+                self.assertLessEqual(len(produced) - len(written), (export.STREAM_BATCHES + 2) * export.STREAM_BATCH_SIZE)
+                produced.append(i)
+                yield (i, f"task {i}", "", "", "", 0, None, None)
+                if fail and i == export.STREAM_BATCH_SIZE * 2:
+                    raise RuntimeError("database went away")
+
+        def write(rows, fileobj):
+            for row in rows:
+                written.append(row)
+            return len(written)
+
+        saved = export.FORMATS["csv"]
+        export.FORMATS["csv"] = write
+        self.addCleanup(export.FORMATS.__setitem__, "csv", saved)
+        _, count = await export.pool.stream(rows(), "csv")
+        self.assertEqual(count, 5 * export.STREAM_BATCH_SIZE)
+        with self.assertRaises(RuntimeError):
+            await export.pool.stream(rows(fail=True), "csv")
+        self.assertEqual(export.pool.pending, 0)
+
+
+class TestPageCache(unittest.TestCase):
+    def test_lru_eviction_within_byte_budget(self):
+        pages = cache.PageCache(max_bytes=3 * (cache.ENTRY_OVERHEAD + 100))
+        for user_id in range(3):
+            pages.put(user_id, "k", f"page {user_id}", 100, pages.generation(user_id))
+        pages.get(0, "k")
+        pages.put(3, "k", "page 3", 100, pages.generation(3))
+        self.assertIsNone(pages.get(1, "k"))
+        self.assertEqual(pages.get(0, "k"), "page 0")
+        self.assertEqual(pages.stats()["evictions"], 1)
+        self.assertLessEqual(pages.size, pages.max_bytes)
+
+    def test_invalidate_only_touches_that_user(self):
+        pages = cache.PageCache()
+        pages.put(1, "a", "x", 1, 0)
+        pages.put(1, "b", "y", 1, 0)
+        pages.put(2, "a", "z", 1, 0)
+        pages.invalidate(1)
+        self.assertIsNone(pages.get(1, "a"))
+        self.assertIsNone(pages.get(1, "b"))
+        self.assertEqual(pages.get(2, "a"), "z")
+        self.assertEqual(pages.stats()["entries"], 1)
+
+    def test_page_rendered_before_a_write_is_not_cached(self):
+        pages = cache.PageCache()
+        generation = pages.generation(1)
+        pages.invalidate(1)
+        pages.put(1, "a", "stale", 1, generation)
+        self.assertIsNone(pages.get(1, "a"))
+
+
+class TestImport(DatabaseTestCase):
+
+    async def test_exports_import_back(self):
+        await storage.add_task(1, 'Quote "this", please', "Alice", "Work", "a,b", ts("2024-01-01 10:00:00"))
+        second = await storage.add_task(1, "Ünïcode", "", "", "", ts("2024-01-01 11:00:00"))
+        await storage.complete_task(1, second, ts("2024-01-02 10:00:00"))
+        path = storage.get_pool().path
+        expected = [row[1:] for row in await storage.fetch_all_tasks(1)]
+        for user_id, fmt in enumerate(export.FORMATS, start=10):
+            with self.subTest(fmt=fmt):
+                data, _ = export.export_tasks(path, 1, fmt)
+                tasks, errors, invalid = importer.parse_file(data, fmt, ts("2025-01-01 00:00:00"))
+                self.assertEqual((errors, invalid), ([], 0))
+                self.assertEqual(await storage.import_tasks(user_id, tasks, chunk_size=1), 2)
+                rows = await storage.fetch_all_tasks(user_id)
+                self.assertEqual([row[1:] for row in rows], expected)
+                self.assertEqual([r[1] for r in await storage.fetch_tasks(user_id, {"tags": "b"})], [expected[0][0]])
+
+    def test_invalid_rows_are_reported_and_skipped(self):
+        rows = [
+            ["Task", "Who", "Created At"],
+            ["Plain", "Bob", ""],
+            ["", "Nobody", ""],
+            [None, None, None],
+            ["Bad date", "", "yesterday"],
+            ["Short row"],
+        ]
+        tasks, errors, invalid = importer.parse_rows(rows, ts("2025-01-01 00:00:00"))
+        self.assertEqual(
+            tasks,
+            [
+                ("Plain", "Bob", "", "", ts("2025-01-01 00:00:00"), None, None),
+                ("Short row", "", "", "", ts("2025-01-01 00:00:00"), None, None),
+            ],
+        )
+        self.assertEqual(invalid, 2)
+        self.assertEqual(errors[0], "row 3: empty task")
+        self.assertTrue(errors[1].startswith("row 5: "))
+
+    def test_unreadable_files(self):
+        with self.assertRaises(importer.InvalidImportFile):
+            importer.parse_file(b"Who,Category\nBob,Home\n", "csv", ts("2025-01-01 00:00:00"))
+        with self.assertRaises(importer.InvalidImportFile):
+            importer.parse_file(b"not a workbook", "xlsx", ts("2025-01-01 00:00:00"))
+        self.assertEqual(importer.format_for("backup.CSV.gz"), "csv.gz")
+        self.assertIsNone(importer.format_for("notes.txt"))
+
+    async def test_document_handler(self):
+        update, context = fakes.command(1, "/import")
+        await tbot.import_command(update, context)
+        update.message.document = fakes.FakeDocument("tasks.csv", b"Task,Tags\nOne,x\n,\nTwo,\n")
+        await tbot.import_document(update, context)
+        self.assertEqual([r[1] for r in await storage.fetch_tasks(1, {})], ["One", "Two"])
+
+        # Without /import first or as caption, documents are left alone.
+        await tbot.import_document(update, context)
+        self.assertEqual(len(await storage.fetch_tasks(1, {})), 2)
+
+
+class TestQueryPlans(DatabaseTestCase):
+    """The /list and /download queries must stay index-backed as task counts grow."""
+
+    async def asyncSetUp(self):
+        await super().asyncSetUp()
+        async with storage.get_pool().writer() as conn:
+            await conn.executemany(
+                "INSERT INTO tasks (user_id, task, created_at, completed_at) VALUES (?, ?, ?, ?)",
+                [
+                    (i % 50, f"task {i}", ts("2024-01-01 10:00:00"), None if i % 3 else ts("2024-01-02 10:00:00"))
+                    for i in range(5000)
+                ],
+            )
+            await conn.execute("ANALYZE")
+
+    async def query_plan(self, sql, params):
+        async with storage.get_pool().reader() as conn:
+            async with conn.execute(f"EXPLAIN QUERY PLAN {sql}", params) as cursor:
+                return " | ".join(row[3] for row in await cursor.fetchall())
+
+    async def assertIndexed(self, sql, params):
+        plan = await self.query_plan(sql, params)
+        self.assertIn("USING", plan)
+        self.assertIsNone(re.search(r"SCAN tasks\b", plan), plan)
+
+    async def test_list_queries_use_index(self):
+        for filters in [
+            {},
+            {"show_completed": "1"},
+            {"who": "Alice"},
+            {"task": "milk", "category": "Home", "tags": "x", "show_completed": "1"},
+            {"task": "milk", "who": "Alice"},
+            {"tags": "work,urgent"},
+            {"tags": "work|urgent", "show_completed": "1"},
+        ]:
+            with self.subTest(filters=filters):
+                await self.assertIndexed(*storage.build_task_query(7, filters))
+
+    async def test_search_is_driven_by_full_text_index(self):
+        plan = await self.query_plan(*storage.build_task_query(7, {"task": "milk"}, limit=21))
+        self.assertTrue(plan.startswith("SCAN tasks_fts VIRTUAL TABLE"), plan)
+        self.assertIn("SEARCH tasks USING INTEGER PRIMARY KEY", plan)
+
+    async def test_list_pages_use_index(self):
+        for filters in [{}, {"show_completed": "1"}, {"tags": "work"}]:
+            with self.subTest(filters=filters):
+                await self.assertIndexed(*storage.build_task_query(7, filters, after=100, limit=21))
+                await self.assertIndexed(*storage.build_task_query(7, filters, before=100, limit=21))
+        plan = await self.query_plan(*storage.build_task_query(7, {"show_completed": "1"}, after=100, limit=21))
+        self.assertNotIn("TEMP B-TREE", plan)
+
+    async def test_date_ranges_use_range_scans(self):
+        # However long the user's history, only the rows in range are read.
+        since = ts("2024-01-02 00:00:00")
+        for kwargs in [{}, {"after": 100}, {"before": 100}]:
+            with self.subTest(**kwargs):
+                query = storage.build_task_query(7, {"status": "done", "completed_from": since}, limit=21, **kwargs)
+                self.assertIn("idx_tasks_user_open (user_id=? AND completed_at>?)", await self.query_plan(*query))
+                query = storage.build_task_query(
+                    7, {"status": "all", "created_from": since, "created_until": since + 86400}, limit=21, **kwargs
+                )
+                plan = await self.query_plan(*query)
+                self.assertIn("idx_tasks_user_created (user_id=? AND created_at>? AND created_at<?)", plan)
+
+    async def test_download_query_uses_index(self):
+        await self.assertIndexed(storage.ALL_TASKS_QUERY, (7,))
+
+
+class TestWebhook(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.app = tbot.build_app("123456:TEST-TOKEN")
+        self.server = webhook.HttpServer("127.0.0.1", 0)
+        self.server.route("/telegram", webhook.telegram_webhook(self.app, "s3cret"), methods=("POST",))
+        self.server.route("/healthz", webhook.health)
+        await self.server.start()
+        self.reader, self.writer = await asyncio.open_connection("127.0.0.1", self.server.port)
+
+    async def asyncTearDown(self):
+        self.writer.close()
+        await self.server.stop()
+
+    def fake_update(self, update_id, text):
+        return {
+            "update_id": update_id,
+            "message": {
+                "message_id": update_id,
+                "date": 1700000000,
+                "chat": {"id": 42, "type": "private"},
+                "from": {"id": 42, "is_bot": False, "first_name": "Alice"},
+                "text": text,
+            },
+        }
+
+    async def request(self, method, path, body=b"", headers=None):
+        head = f"{method} {path} HTTP/1.1\r\nHost: localhost\r\nContent-Length: {len(body)}\r\n"
+        for name, value in (headers or {}).items():
+            head += f"{name}: {value}\r\n"
+        self.writer.write(head.encode() + b"\r\n" + body)
+        status_line = await self.reader.readline()
+        headers = {}
+        while (line := await self.reader.readline()) != b"\r\n":
+            name, value = line.decode().split(":", 1)
+            headers[name.lower()] = value.strip()
+        await self.reader.readexactly(int(headers["content-length"]))
+        return int(status_line.split()[1])
+
+    async def test_updates_are_queued_over_one_connection(self):
+        for update_id, text in [(1, "/add Buy milk"), (2, "/list")]:
+            body = json.dumps(self.fake_update(update_id, text)).encode()
+            status = await self.request(
+                "POST", "/telegram", body, {"X-Telegram-Bot-Api-Secret-Token": "s3cret"}
+            )
+            self.assertEqual(status, 200)
+        first = self.app.update_queue.get_nowait()
+        second = self.app.update_queue.get_nowait()
+        self.assertEqual((first.update_id, first.message.text), (1, "/add Buy milk"))
+        self.assertEqual(second.message.from_user.id, 42)
+
+    async def test_rejects_wrong_secret_and_bad_requests(self):
+        body = json.dumps(self.fake_update(1, "/list")).encode()
+        wrong = {"X-Telegram-Bot-Api-Secret-Token": "x"}
+        right = {"X-Telegram-Bot-Api-Secret-Token": "s3cret"}
+        self.assertEqual(await self.request("POST", "/telegram", body, wrong), 403)
+        self.assertEqual(await self.request("POST", "/telegram", b"{not json", right), 400)
+        self.assertEqual(await self.request("GET", "/telegram"), 405)
+        self.assertEqual(await self.request("GET", "/elsewhere"), 404)
+        self.assertEqual(await self.request("GET", "/healthz"), 200)
+        self.assertTrue(self.app.update_queue.empty())
+
+    async def test_rejects_everything_without_a_configured_secret(self):
+        self.server.route("/open", webhook.telegram_webhook(self.app, None), methods=("POST",))
+        body = json.dumps(self.fake_update(1, "/list")).encode()
+        self.assertEqual(await self.request("POST", "/open", body), 403)
+        self.assertEqual(await self.request("POST", "/open", body, {"X-Telegram-Bot-Api-Secret-Token": ""}), 403)
+        self.assertTrue(self.app.update_queue.empty())
+
+    def test_webhook_mode_requires_a_secret_token(self):
+        saved = os.environ.pop("WEBHOOK_SECRET_TOKEN", None)
+        if saved is not None:
+            self.addCleanup(os.environ.__setitem__, "WEBHOOK_SECRET_TOKEN", saved)
+        with self.assertRaises(SystemExit), contextlib.redirect_stderr(io.StringIO()):
+            tbot.parse_args(["--mode", "webhook"])
+        self.assertEqual(tbot.parse_args(["--mode", "webhook", "--secret-token", "s"]).secret_token, "s")
+        self.assertIsNone(tbot.parse_args([]).secret_token)
+
+
+def user_update(user_id, seq):
+    """An update from user_id whose update_id is its place in the arrival order."""
+    return fakes.FakeUpdate(message=fakes.FakeMessage(user_id), update_id=seq)
+
+
+class TestPerUserUpdateProcessor(unittest.IsolatedAsyncioTestCase):
+    async def run_updates(self, processor, updates, handle):
+        # Mirrors Application: one task per update, created in arrival order.
+        tasks = [asyncio.ensure_future(processor.process_update(u, handle(u))) for u in updates]
+        await asyncio.gather(*tasks)
+
+    async def test_stress_keeps_per_user_order_and_bounds_concurrency(self):
+        rng = random.Random(1)
+        processor = concurrency.PerUserUpdateProcessor(max_concurrent_updates=5, max_pending_updates=40)
+        updates = [user_update(rng.randint(1, 20), seq) for seq in range(500)]
+        seen = {}
+        running = 0
+        peak = 0
+
+        async def handle(update):
+            nonlocal running, peak
+            running += 1
+            peak = max(peak, running)
+            await asyncio.sleep(rng.random() / 1000)
+            seen.setdefault(update.effective_user.id, []).append(update.update_id)
+            running -= 1
+
+        await self.run_updates(processor, updates, handle)
+        for user_id, seqs in seen.items():
+            self.assertEqual(seqs, sorted(seqs), f"user {user_id} updates reordered")
+        self.assertEqual(sum(len(s) for s in seen.values()), 500)
+        self.assertEqual(peak, 5)
+        self.assertEqual(processor.active_users, 0)
+
+    async def test_slow_update_does_not_block_other_users(self):
+        processor = concurrency.PerUserUpdateProcessor(max_concurrent_updates=4)
+        release = asyncio.Event()
+        finished = []
+
+        async def handle(update):
+            if update.update_id == 0:
+                await release.wait()
+            finished.append(update.update_id)
+
+        updates = [user_update(1, 0), user_update(1, 1), user_update(2, 2), user_update(3, 3)]
+        job = asyncio.ensure_future(self.run_updates(processor, updates, handle))
+        await asyncio.sleep(0.01)
+        self.assertEqual(finished, [2, 3])
+        release.set()
+        await job
+        self.assertEqual(finished, [2, 3, 0, 1])
+
+    async def test_failed_update_releases_the_next_one(self):
+        processor = concurrency.PerUserUpdateProcessor(max_concurrent_updates=2)
+        finished = []
+
+        async def handle(update):
+            if update.update_id == 0:
+                raise RuntimeError("handler failed")
+            finished.append(update.update_id)
+
+        tasks = [
+            asyncio.ensure_future(processor.process_update(u, handle(u)))
+            for u in [user_update(1, 0), user_update(1, 1)]
+        ]
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+        self.assertIsInstance(results[0], RuntimeError)
+        self.assertEqual(finished, [1])
+
+
+class FakeBot:
+    """Records what would have been sent, answering with 429s while flood_waits lasts."""
+
+    def __init__(self, flood_waits=()):
+        self.flood_waits = list(flood_waits)
+        self.calls = []  # (monotonic time, endpoint, data, delivered)
+        self.started = time.monotonic()
+
+    def request(self, endpoint, data):
+        async def callback():
+            delivered = not self.flood_waits
+            self.calls.append((time.monotonic() - self.started, endpoint, data, delivered))
+            if not delivered:
+                raise RetryAfter(timedelta(seconds=self.flood_waits.pop(0)))
+            return {"endpoint": endpoint, **data}
+
+        return callback, (), {}, endpoint, data, None
+
+    def delivered(self, endpoint=None):
+        return [c for c in self.calls if c[3] and endpoint in (None, c[1])]
+
+
+class TestSendScheduler(unittest.IsolatedAsyncioTestCase):
+    async def scheduler(self, **kwargs):
+        kwargs = {"global_rate": 1000, "chat_rate": 1000, "chat_burst": 10, **kwargs}
+        scheduler = ratelimit.SendScheduler(**kwargs)
+        await scheduler.initialize()
+        self.addAsyncCleanup(scheduler.shutdown)
+        return scheduler
+
+    def send(self, scheduler, bot, endpoint, **data):
+        return asyncio.ensure_future(scheduler.process_request(*bot.request(endpoint, data)))
+
+    async def test_retry_after_pauses_all_sends_then_retries(self):
+        scheduler = await self.scheduler()
+        bot = FakeBot(flood_waits=[0.1])
+        first = self.send(scheduler, bot, "sendMessage", chat_id=1, text="a")
+        await asyncio.sleep(0.02)
+        second = self.send(scheduler, bot, "sendMessage", chat_id=2, text="b")
+        self.assertEqual((await first)["text"], "a")
+        self.assertEqual((await second)["text"], "b")
+        failed, *rest = bot.calls
+        self.assertFalse(failed[3])
+        self.assertEqual([c[2]["text"] for c in rest], ["a", "b"])
+        # Neither the retry nor the other chat's message went out during the flood wait.
+        self.assertGreaterEqual(min(c[0] for c in rest) - failed[0], 0.09)
+        self.assertEqual(scheduler.retries, 1)
+
+    async def test_gives_up_after_max_retries(self):
+        scheduler = await self.scheduler(max_retries=2)
+        bot = FakeBot(flood_waits=[0.01] * 5)
+        with self.assertRaises(RetryAfter):
+            await self.send(scheduler, bot, "sendMessage", chat_id=1, text="a")
+        self.assertEqual(len(bot.calls), 3)
+        self.assertEqual(scheduler.queued, 0)
+
+    async def test_chats_are_limited_separately(self):
+        scheduler = await self.scheduler(chat_rate=20, chat_burst=1)
+        bot = FakeBot()
+        jobs = [self.send(scheduler, bot, "sendMessage", chat_id=1, text=str(i)) for i in range(3)]
+        jobs.append(self.send(scheduler, bot, "sendMessage", chat_id=2, text="other"))
+        await asyncio.gather(*jobs)
+        self.assertEqual([c[2]["text"] for c in bot.calls], ["0", "other", "1", "2"])
+        times = [c[0] for c in bot.calls if c[2]["chat_id"] == 1]
+        for earlier, later in zip(times, times[1:]):
+            self.assertGreaterEqual(later - earlier, 0.045)
+
+    async def test_waiting_edits_of_a_message_are_merged(self):
+        scheduler = await self.scheduler(chat_rate=10, chat_burst=1)
+        bot = FakeBot()
+        reply = self.send(scheduler, bot, "sendMessage", chat_id=1, text="list")
+        edits = [
+            self.send(scheduler, bot, "editMessageText", chat_id=1, message_id=7, text=f"page {i}")
+            for i in range(1, 6)
+        ]
+        other = self.send(scheduler, bot, "editMessageText", chat_id=1, message_id=8, text="x")
+        results = await asyncio.gather(reply, *edits, other)
+        sent = [c[2]["text"] for c in bot.delivered("editMessageText")]
+        self.assertEqual(sent, ["page 5", "x"])
+        self.assertEqual({r["text"] for r in results[1:6]}, {"page 5"})
+        self.assertEqual(scheduler.merged_edits, 4)
+
+    async def test_interactive_replies_go_before_exports(self):
+        scheduler = await self.scheduler(global_rate=5)
+        bot = FakeBot()
+        await asyncio.gather(*[self.send(scheduler, bot, "sendMessage", chat_id=i, text="") for i in range(5)])
+        # The global bucket is empty now: whatever is queued waits for the next token.
+        export = self.send(scheduler, bot, "sendDocument", chat_id=10, document="tasks.xlsx")
+        reply = self.send(scheduler, bot, "sendMessage", chat_id=11, text="hi")
+        await asyncio.gather(export, reply)
+        self.assertEqual([c[1] for c in bot.calls[5:]], ["sendMessage", "sendDocument"])
+
+    async def test_requests_without_a_chat_are_not_throttled(self):
+        scheduler = await self.scheduler(global_rate=1)
+        bot = FakeBot()
+        await self.send(scheduler, bot, "sendMessage", chat_id=1, text="a")
+        start = time.monotonic()
+        await asyncio.gather(*[self.send(scheduler, bot, "answerCallbackQuery", callback_query_id=str(i)) for i in range(5)])
+        self.assertLess(time.monotonic() - start, 0.5)
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestMetrics(DatabaseTestCase):
+    async def asyncSetUp(self):
+        self.clock = FakeClock()
+        self.saved, metrics.registry = metrics.registry, metrics.Registry(self.clock)
+        await super().asyncSetUp()
+
+    async def asyncTearDown(self):
+        await super().asyncTearDown()
+        metrics.registry = self.saved
+
+    async def test_handler_latency_and_errors(self):
+        async def slow(update, context):
+            self.clock.now += 0.03
+
+        async def broken(update, context):
+            self.clock.now += 2
+            raise ValueError("boom")
+
+        await metrics.instrument("slow", slow)(*fakes.command(1, "/slow"))
+        with self.assertRaises(ValueError):
+            await metrics.instrument("broken", broken)(*fakes.command(1, "/broken"))
+        text = metrics.registry.render()
+        self.assertIn('bot_handler_seconds_bucket{handler="slow",le="0.025"} 0', text)
+        self.assertIn('bot_handler_seconds_bucket{handler="slow",le="0.05"} 1', text)
+        self.assertIn('bot_handler_seconds_bucket{handler="broken",le="1"} 0', text)
+        self.assertIn('bot_handler_seconds_count{handler="broken"} 1', text)
+        self.assertIn('bot_handler_errors_total{handler="broken",error="ValueError"} 1', text)
+        self.assertNotIn('bot_handler_errors_total{handler="slow"', text)
+
+    async def test_database_work_is_charged_to_the_handler(self):
+        clock = self.clock
+
+        class TimedConnection:
+            # Every query takes 10ms on the fake clock.
+            def __init__(self, conn):
+                self.conn = conn
+
+            def execute(self, *args):
+                clock.now += 0.01
+                return self.conn.execute(*args)
+
+            def __getattr__(self, name):
+                return getattr(self.conn, name)
+
+        pool = storage.get_pool()
+        pool._writer = TimedConnection(pool._writer)
+        reader = pool._idle_readers.get_nowait()
+        pool._idle_readers.put_nowait(TimedConnection(reader))
+
+        await metrics.instrument("add", tbot.add)(*fakes.command(1, "/add One\nTwo\nThree"))
+        await metrics.instrument("list_tasks", tbot.list_tasks)(*fakes.command(1, "/list"))
+        registry = metrics.registry
+        self.assertEqual(registry.db_seconds.count("add", "write"), 1)
+        self.assertGreater(registry.db_seconds.sum("add", "write"), 0)
+        self.assertEqual(registry.db_rows.count("list_tasks"), 1)
+        self.assertEqual(registry.db_rows.sum("list_tasks"), 3)
+        # One listing query and the user's timezone, 10ms each.
+        self.assertEqual(registry.db_seconds.count("list_tasks", "read"), 2)
+        self.assertAlmostEqual(registry.db_seconds.sum("list_tasks", "read"), 0.02)
+        # Handler time includes the database time.
+        self.assertGreaterEqual(registry.handler_seconds.sum("list_tasks"), 0.01)
+
+    async def test_outgoing_message_sizes_and_flood_waits(self):
+        scheduler = ratelimit.SendScheduler(global_rate=1000, chat_rate=1000)
+        await scheduler.initialize()
+        self.addAsyncCleanup(scheduler.shutdown)
+        bot = FakeBot(flood_waits=[0.01])
+        await scheduler.process_request(*bot.request("sendMessage", {"chat_id": 1, "text": "é" * 50}))
+        registry = metrics.registry
+        self.assertEqual(registry.message_bytes.count("sendMessage"), 1)
+        self.assertEqual(registry.message_bytes.sum("sendMessage"), 100)
+        self.assertEqual(registry.flood_waits.get("sendMessage"), 1)
+
+    async def test_metrics_endpoint(self):
+        metrics.registry.handler_errors.inc("add", "ValueError")
+        server = webhook.HttpServer("127.0.0.1", 0)
+        server.route("/metrics", metrics.serve)
+        await server.start()
+        try:
+            reader, writer = await asyncio.open_connection("127.0.0.1", server.port)
+            writer.write(b"GET /metrics HTTP/1.1\r\nHost: localhost\r\nConnection: close\r\n\r\n")
+            response = (await reader.read()).decode()
+            writer.close()
+        finally:
+            await server.stop()
+        self.assertTrue(response.startswith("HTTP/1.1 200"))
+        self.assertIn("# TYPE bot_handler_seconds histogram", response)
+        self.assertIn('bot_handler_errors_total{handler="add",error="ValueError"} 1', response)
+
+
+class TestLogs(DatabaseTestCase):
+    async def asyncSetUp(self):
+        await super().asyncSetUp()
+        root = logging.getLogger()
+        self.saved = root.handlers[:], root.level
+        self.log_path = os.path.join(self.tmpdir.name, "bot.log")
+        self.listener = logs.setup("DEBUG", ["file:" + self.log_path], debug_sample_rate=1)
+
+    async def asyncTearDown(self):
+        if self.listener is not None:
+            self.listener.stop()
+        root = logging.getLogger()
+        for handler in root.handlers[:]:
+            root.removeHandler(handler)
+        for handler in self.saved[0]:
+            root.addHandler(handler)
+        root.setLevel(self.saved[1])
+        await super().asyncTearDown()
+
+    def records(self, logger):
+        self.listener.stop()
+        self.listener = None
+        with open(self.log_path, encoding="utf-8") as f:
+            records = [json.loads(line) for line in f]
+        return [r for r in records if r["logger"] == logger]
+
+    async def test_records_carry_the_update_they_were_logged_for(self):
+        update, context = fakes.command(7, "/list")
+        update.update_id = 1234
+        await logs.correlate("list_tasks", tbot.list_tasks)(update, context)
+        try:
+            raise ValueError("boom")
+        except ValueError:
+            logging.getLogger("tbot").exception("outside a handler")
+        page, failure = self.records("tbot")
+        self.assertEqual(page["msg"], "formatting task page")
+        self.assertEqual(page["level"], "DEBUG")
+        self.assertEqual(
+            (page["update_id"], page["user_id"], page["handler"]), (1234, 7, "list_tasks")
+        )
+        self.assertEqual(page["filters"], {})
+        self.assertNotIn("handler", failure)
+        self.assertIn("ValueError: boom", failure["exc"])
+
+    async def test_debug_records_are_sampled(self):
+        rng = random.Random(1)
+        sampling = logs.SamplingFilter(0.1, rng.random)
+        debug = logging.makeLogRecord({"levelno": logging.DEBUG})
+        info = logging.makeLogRecord({"levelno": logging.INFO})
+        kept = sum(sampling.filter(debug) for _ in range(10000))
+        self.assertTrue(900 < kept < 1100, kept)
+        self.assertTrue(all(sampling.filter(info) for _ in range(100)))
+
+    async def test_unknown_sinks_are_rejected(self):
+        self.assertEqual(logs.sink("file:/tmp/bot.log"), "file:/tmp/bot.log")
+        with self.assertRaises(ValueError):
+            logs.sink("syslog")
+
+
+class TestQueryProfiler(DatabaseTestCase):
+    async def asyncSetUp(self):
+        self.ticks = 0
+
+        def clock():
+            # Every statement takes 10ms: one tick before it, one after.
+            self.ticks += 1
+            return self.ticks * 0.01
+
+        self.saved, profiling.queries = profiling.queries, profiling.QueryProfiler(5, clock)
+        await super().asyncSetUp()
+        await storage.add_tasks(1, [("Buy milk", "Me", "home", "")] * 3, ts("2024-01-01 10:00:00"))
+
+    async def asyncTearDown(self):
+        await super().asyncTearDown()
+        profiling.queries = self.saved
+
+    def test_normalize(self):
+        self.assertEqual(
+            profiling.normalize("SELECT *\n  FROM tasks WHERE id IN (?, ?,?) AND who = 'Bob' LIMIT 21"),
+            "SELECT * FROM tasks WHERE id IN (?, ...) AND who = ? LIMIT ?",
+        )
+        self.assertEqual(profiling.normalize("SELECT t1.id FROM tasks t1"), "SELECT t1.id FROM tasks t1")
+
+    async def test_statements_are_aggregated_by_shape_with_plans(self):
+        profiler = profiling.queries
+        await storage.fetch_tasks(1, {"who": "Me"})
+        profiler.enabled = True
+        await storage.fetch_tasks(1, {"who": "Me"})
+        await storage.fetch_tasks(1, {"who": "You"})
+        await storage.fetch_tasks(1, {"category": "home"})
+        await storage.complete_task(1, 1, ts("2024-01-02 10:00:00"))
+        profiler.enabled = False
+        await storage.fetch_tasks(1, {"category": "home"})
+
+        by_who = [stats for shape, stats in profiler.shapes.items() if "who LIKE" in shape]
+        self.assertEqual([(s.count, s.total, s.slow) for s in by_who], [(2, 20.0, 2)])
+        self.assertIn("idx_tasks_user", by_who[0].plan)
+        writes = [shape for shape in profiler.shapes if shape.startswith("UPDATE tasks")]
+        self.assertEqual(len(writes), 1)
+        report = profiler.report(top=1)
+        self.assertIn("20.0ms total", report)
+        self.assertIn("who LIKE", report)
+        self.assertEqual(len(profiler.slow), sum(s.count for s in profiler.shapes.values()))
+
+    async def test_fast_statements_are_not_explained(self):
+        profiler = profiling.queries
+        profiler.threshold_ms = 50
+        profiler.enabled = True
+        await storage.fetch_tasks(1, {})
+        self.assertTrue(profiler.shapes)
+        self.assertFalse(profiler.slow)
+        self.assertTrue(all(stats.plan is None for stats in profiler.shapes.values()))
+
+    async def test_profile_command_is_admin_only(self):
+        tbot.ADMIN_USER_IDS.add(99)
+        self.addCleanup(tbot.ADMIN_USER_IDS.discard, 99)
+        update, context = fakes.command(1, "/profile on")
+        await tbot.profile_command(update, context)
+        self.assertIn("only available to admins", update.message.replies[0])
+        self.assertFalse(profiling.queries.enabled)
+
+        update, context = fakes.command(99, "/profile on 1")
+        await tbot.profile_command(update, context)
+        self.assertTrue(profiling.queries.enabled)
+        self.assertEqual(profiling.queries.threshold_ms, 1)
+        await tbot.list_tasks(*fakes.command(99, "/list"))
+        update, context = fakes.command(99, "/profile report 3")
+        await tbot.profile_command(update, context)
+        self.assertIn("Query profiling is on", update.message.replies[0])
+        self.assertIn("FROM tasks", update.message.replies[0])
+        await tbot.profile_command(*fakes.command(99, "/profile off"))
+        self.assertFalse(profiling.queries.enabled)
+
+
+class RepositoryConformance:
+    """Behaviour every repository backend must share; mixed into one DatabaseTestCase per backend."""
+
+    open_storage = False
+
+    def make_repository(self):
+        raise NotImplementedError
+
+    async def asyncSetUp(self):
+        await super().asyncSetUp()
+        self.repo = self.make_repository()
+        await self.repo.open()
+        self.t0 = ts("2024-01-01 10:00:00")
+        self.ids = await self.repo.add_tasks(
+            1,
+            [
+                ("Buy milk", "Alice", "Home", "grocery,urgent"),
+                ("Call mum", "Bob", "family", "phone"),
+                ("Write report", "alice", "Work", "urgent"),
+                ("Pay taxes", "", "", ""),
+            ],
+            self.t0,
+        )
+        await self.repo.add_task(2, "Other user's milk", "Alice", "Home", "grocery", self.t0)
+
+    async def asyncTearDown(self):
+        await self.repo.close()
+        await super().asyncTearDown()
+
+    async def ids_of(self, filters, user_id=1):
+        return sorted(row[0] for row in await self.repo.fetch_tasks(user_id, filters))
+
+    async def test_add_returns_ids_and_rows_in_order(self):
+        self.assertEqual(self.ids, sorted(self.ids))
+        rows = await self.repo.fetch_all_tasks(1)
+        self.assertEqual([row[0] for row in rows], self.ids)
+        self.assertEqual(rows[0], (self.ids[0], "Buy milk", "Alice", "Home", "grocery,urgent", self.t0, None, None))
+        self.assertEqual([row[1] for row in await self.repo.fetch_all_tasks(2)], ["Other user's milk"])
+
+    async def test_complete_outcomes(self):
+        milk, call = self.ids[:2]
+        results = await self.repo.complete_tasks(1, [milk, 999999], self.t0 + 60)
+        self.assertEqual(results, {milk: storage.COMPLETED, 999999: storage.NOT_FOUND})
+        self.assertFalse(await self.repo.complete_task(1, milk, self.t0 + 120))
+        self.assertTrue(await self.repo.complete_task(1, call, self.t0 + 120))
+        (other,) = [row[0] for row in await self.repo.fetch_all_tasks(2)]
+        self.assertEqual(await self.repo.complete_tasks(1, [other], self.t0), {other: storage.NOT_FOUND})
+        rows = {row[0]: row for row in await self.repo.fetch_all_tasks(1)}
+        self.assertEqual((rows[milk][7], rows[call][7]), (self.t0 + 60, self.t0 + 120))
+
+    async def test_update_and_delete(self):
+        milk = self.ids[0]
+        self.assertTrue(await self.repo.update_task(1, milk, {"who": "Carol", "tags": "dairy", "updated_at": self.t0 + 5}))
+        self.assertEqual(await self.ids_of({"tags": "dairy"}), [milk])
+        self.assertEqual(await self.ids_of({"tags": "grocery"}), [])
+        row = (await self.repo.fetch_tasks(1, {"who": "carol"}))[0]
+        self.assertEqual((row[2], row[4], row[6]), ("Carol", "dairy", self.t0 + 5))
+        self.assertFalse(await self.repo.update_task(2, milk, {"who": "Mallory"}))
+        self.assertFalse(await self.repo.delete_task(2, milk))
+        self.assertTrue(await self.repo.delete_task(1, milk))
+        self.assertFalse(await self.repo.delete_task(1, milk))
+        self.assertNotIn(milk, [row[0] for row in await self.repo.fetch_all_tasks(1)])
+
+    async def test_filters(self):
+        milk, call, report, taxes = self.ids
+        await self.repo.complete_task(1, call, ts("2024-01-03 09:00:00"))
+        self.assertEqual(await self.ids_of({}), [milk, report, taxes])
+        self.assertEqual(await self.ids_of({"status": "done"}), [call])
+        self.assertEqual(await self.ids_of({"status": "all"}), self.ids)
+        self.assertEqual(await self.ids_of({"show_completed": "1"}), self.ids)
+        self.assertEqual(await self.ids_of({"who": "ALICE"}), [milk, report])
+        self.assertEqual(await self.ids_of({"category": "ome"}), [milk])
+        self.assertEqual(await self.ids_of({"task": "milk"}), [milk])
+        self.assertEqual(await self.ids_of({"task": "wri rep"}), [report])
+        self.assertEqual(await self.ids_of({"tags": "URGENT"}), [milk, report])
+        self.assertEqual(await self.ids_of({"tags": "grocery,urgent"}), [milk])
+        self.assertEqual(await self.ids_of({"tags": "grocery|phone", "status": "all"}), [milk, call])
+        self.assertEqual(await self.ids_of({"status": "all", "created_from": self.t0}), self.ids)
+        self.assertEqual(await self.ids_of({"status": "all", "created_until": self.t0}), [])
+        self.assertEqual(await self.ids_of({"status": "done", "completed_from": ts("2024-01-03")}), [call])
+        self.assertEqual(await self.ids_of({"status": "done", "completed_from": ts("2024-01-04")}), [])
+
+    async def test_keyset_pages(self):
+        first, has_more = await self.repo.fetch_task_page(1, {"status": "all"}, limit=3)
+        self.assertEqual(([row[0] for row in first], has_more), (self.ids[:3], True))
+        second, has_more = await self.repo.fetch_task_page(1, {"status": "all"}, after=first[-1][0], limit=3)
+        self.assertEqual(([row[0] for row in second], has_more), (self.ids[3:], False))
+        back, has_more = await self.repo.fetch_task_page(1, {"status": "all"}, before=second[0][0], limit=2)
+        self.assertEqual(([row[0] for row in back], has_more), (self.ids[1:3], True))
+
+    async def test_stats(self):
+        milk, call = self.ids[:2]
+        await self.repo.complete_tasks(1, [milk, call], ts("2024-01-07 23:00:00"))
+        await self.repo.update_task(1, self.ids[3], {"category": "home"})
+        # Values that differ only in case are counted together, under either spelling.
+        stats = {k: sorted((value.lower(), o, d) for value, o, d in v) for k, v in (await self.repo.fetch_stats(1)).items()}
+        self.assertEqual(stats["status"], [("", 2, 2)])
+        self.assertEqual(stats["category"], [("family", 0, 1), ("home", 1, 1), ("work", 1, 0)])
+        self.assertEqual(stats["who"], [("", 1, 0), ("alice", 1, 1), ("bob", 0, 1)])
+        self.assertEqual(stats["tag"], [("grocery", 0, 1), ("phone", 0, 1), ("urgent", 1, 1)])
+        self.assertEqual(stats["week"], [("2024-01-01", 0, 2)])
+
+    async def test_timezone(self):
+        self.assertEqual(await self.repo.fetch_timezone(1), timeutil.DEFAULT_TIMEZONE)
+        await self.repo.set_timezone(1, "Europe/Berlin")
+        await self.repo.set_timezone(1, "Asia/Tokyo")
+        self.assertEqual(await self.repo.fetch_timezone(1), "Asia/Tokyo")
+        self.assertEqual(await self.repo.fetch_timezone(2), timeutil.DEFAULT_TIMEZONE)
+
+    async def test_import_and_export_stream(self):
+        rows = [(f"Imported {i}", "Dan", "", "bulk", self.t0 + i, None, self.t0 + 99 if i % 2 else None) for i in range(5)]
+        self.assertEqual(await self.repo.import_tasks(3, rows, chunk_size=2), 5)
+        streamed = [row async for row in self.repo.iter_all_tasks(3)]
+        self.assertEqual([row[1:] for row in streamed], rows)
+        self.assertEqual(await self.ids_of({"tags": "bulk", "status": "done"}, user_id=3), [streamed[1][0], streamed[3][0]])
+        data, count = await self.repo.export_tasks(3, "jsonl", "UTC")
+        self.assertEqual(count, 5)
+        first = json.loads(data.splitlines()[0])
+        self.assertEqual(first["task"], "Imported 0")
+        self.assertEqual(first["created_at"], "2024-01-01 10:00:00")
+
+
+class TestSqliteRepository(RepositoryConformance, DatabaseTestCase):
+    def make_repository(self):
+        return repository.SqliteRepository(self.path, readers=1)
+
+
+class TestMemoryRepository(RepositoryConformance, DatabaseTestCase):
+    def make_repository(self):
+        return repository.MemoryRepository()
+
+    async def test_handlers_run_on_the_selected_backend(self):
+        saved = repository.current()
+        repository.use(self.repo)
+        self.addCleanup(repository.use, saved)
+        update, context = fakes.command(5, "/add Water plants tags=garden")
+        await tbot.add(update, context)
+        await tbot.list_tasks(*fakes.command(5, "/list tags=garden"))
+        self.assertEqual([row[1] for row in await self.repo.fetch_all_tasks(5)], ["Water plants"])
+
+
+class TestTortoiseRepository(RepositoryConformance, DatabaseTestCase):
+    def make_repository(self):
+        return repository.TortoiseRepository("sqlite://" + self.path)
+
+    async def test_ids_are_reserved_in_blocks(self):
+        import models
+
+        rows = [(f"Imported {i}", "", "", "a", self.t0, None, None) for i in range(25)]
+        await self.repo.import_tasks(3, rows, chunk_size=10)
+        ids = [row[0] for row in await self.repo.fetch_all_tasks(3)]
+        self.assertEqual(ids, list(range(ids[0], ids[0] + 25)))
+        self.assertEqual(len(await self.ids_of({"tags": "a"}, user_id=3)), 25)
+        # A database written before the counter existed continues above its ids.
+        await models.Sequence.filter(name="tasks").delete()
+        await self.repo.close()
+        await self.repo.open()
+        self.assertGreater(await self.repo.add_task(3, "New", "", "", "", self.t0), ids[-1])
+
+
+class TestRepositoryUrls(unittest.TestCase):
+    def test_from_url(self):
+        self.assertIsInstance(repository.from_url("memory://"), repository.MemoryRepository)
+        self.assertEqual(repository.from_url("tasks.db").path, "tasks.db")
+        self.assertEqual(repository.from_url("sqlite:////var/lib/bot/tasks.db").path, "/var/lib/bot/tasks.db")
+        self.assertEqual(repository.from_url("postgres://bot@db/tasks").db_url, "postgres://bot@db/tasks")
+        self.assertEqual(repository.from_url("tortoise+sqlite://tasks.db").db_url, "sqlite://tasks.db")
+
+    def test_incomplete_backend_cannot_be_created(self):
+        class Incomplete(repository.TaskRepository):
+            async def add_tasks(self, user_id, items, created_at):
+                return []
+
+        with self.assertRaisesRegex(TypeError, "iter_all_tasks"):
+            Incomplete()
+
+
+class TestBenchmarkHarness(unittest.TestCase):
+    def test_handlers_benchmark_runs_end_to_end(self):
+        import argparse
+
+        import bench
+
+        for storage_url in ("sqlite", "memory://"):
+            with self.subTest(storage=storage_url):
+                args = argparse.Namespace(users=2, tasks=20, ops=10, concurrency=2, seed=0, db=None, storage=storage_url)
+                lines = bench.run_handlers(args)
+                self.assertEqual(len(lines), 3 + len(bench.handler_workloads(1, 1, None)))
+                self.assertTrue(all("ops/s" in line for line in lines[2:-1]))
+
+    def test_seeded_tasks_have_tags(self):
+        import bench
+
+        async def tag_listing(repo, seed=None):
+            await repo.open()
+            try:
+                if seed:
+                    await seed(repo)
+                return await repo.fetch_tasks(1, {"tags": "tag0", "status": "all"}), await repo.fetch_stats(1)
+            finally:
+                await repo.close()
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "tasks.db")
+            asyncio.run(bench.seed(path, 2, 20))
+            backends = {
+                "sqlite": (repository.SqliteRepository(path), None),
+                "memory://": (repository.MemoryRepository(), lambda repo: bench.seed_repository(repo, 2, 20)),
+            }
+            for name, (repo, seed) in backends.items():
+                with self.subTest(storage=name):
+                    rows, stats = asyncio.run(tag_listing(repo, seed))
+                    # Tasks 0, 5, 10, 11 and 15 have tag0; 0 and 15 are done.
+                    self.assertEqual(len(rows), 5)
+                    self.assertIn(("tag0", 3, 2), stats["tag"])
+
+
 if __name__ == "__main__":
     unittest.main()
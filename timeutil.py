@@ -0,0 +1,74 @@
+"""
+Timestamp helpers.
+
+Times are stored as integer seconds since the epoch (UTC), which sort and
+compare as plain integers in SQLite indexes. They are only turned into
+wall-clock text when shown to a user, in the timezone that user picked.
+"""
+import os
+import re
+import time
+from datetime import datetime, timedelta
+
+import pytz
+
+DISPLAY_FORMAT = "%Y-%m-%d %H:%M:%S"
+# Timezone of users who have not picked one with /timezone.
+DEFAULT_TIMEZONE = os.getenv("DEFAULT_TIMEZONE") or "UTC"
+
+UnknownTimeZoneError = pytz.UnknownTimeZoneError
+
+# "7d", "2w": that many days or weeks ago
+RELATIVE_DATE = re.compile(r"(\d+)([dw])")
+
+
+def now() -> int:
+    return int(time.time())
+
+
+def get_timezone(name: str):
+    """The pytz timezone called name. Raises UnknownTimeZoneError."""
+    # pytz keeps its own cache of loaded zones.
+    return pytz.timezone(name)
+
+
+def format_timestamp(epoch, tz_name: str):
+    """Wall-clock text of epoch in tz_name, or None if epoch is None."""
+    if epoch is None:
+        return None
+    return datetime.fromtimestamp(epoch, get_timezone(tz_name)).strftime(DISPLAY_FORMAT)
+
+
+def to_epoch(value: datetime, tz_name: str) -> int:
+    """Epoch seconds of value, read as wall-clock time in tz_name unless it carries its own tzinfo."""
+    if value.tzinfo is None:
+        value = get_timezone(tz_name).localize(value)
+    return int(value.timestamp())
+
+
+def parse_timestamp(text: str, tz_name: str) -> int:
+    """
+    Epoch seconds of an ISO 8601 date or date and time ("2024-01-31",
+    "2024-01-31 10:00:00") in tz_name. Raises ValueError.
+    """
+    return to_epoch(datetime.fromisoformat(text.strip()), tz_name)
+
+
+def parse_date(text: str, tz_name: str, now: int = None) -> int:
+    """
+    Epoch seconds of a date filter in tz_name: an ISO 8601 date or date and
+    time, "today", "yesterday", or "7d"/"2w" for midnight that many days or
+    weeks ago. Raises ValueError.
+    """
+    text = text.strip()
+    word = text.lower()
+    m = RELATIVE_DATE.fullmatch(word)
+    if m:
+        days = int(m.group(1)) * (7 if m.group(2) == "w" else 1)
+    elif word in ("today", "yesterday"):
+        days = 0 if word == "today" else 1
+    else:
+        return parse_timestamp(text, tz_name)
+    today = datetime.fromtimestamp(now if now is not None else time.time(), get_timezone(tz_name)).date()
+    midnight = datetime.combine(today - timedelta(days=days), datetime.min.time())
+    return to_epoch(midnight, tz_name)
@@ -0,0 +1,159 @@
+"""
+Minimal HTTP server for running the bot behind a webhook.
+
+Telegram POSTs every update as JSON to the webhook URL; the server checks the
+secret token header and hands the update to the Application's update queue,
+exactly where polling would have put it. The bot keeps state in its process
+(pending /import uploads, remembered /list filters, per-user update order, the
+send queue), so every update of a user must reach the same process; see the
+README before running more than one.
+"""
+import asyncio
+import hmac
+import json
+
+from telegram import Update
+
+# Updates are small; anything much bigger is not from Telegram.
+MAX_BODY_SIZE = 1024 * 1024
+# Seconds a client may take to send a request before the connection is dropped.
+READ_TIMEOUT = 30
+
+REASONS = {
+    200: "OK",
+    400: "Bad Request",
+    403: "Forbidden",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    413: "Payload Too Large",
+}
+
+
+class Request:
+    def __init__(self, method: str, path: str, headers: dict, body: bytes):
+        self.method = method
+        self.path = path
+        self.headers = headers
+        self.body = body
+
+
+class Response:
+    def __init__(self, status: int = 200, body: bytes = b"", content_type: str = "text/plain; charset=utf-8"):
+        self.status = status
+        self.body = body
+        self.content_type = content_type
+
+
+class HttpServer:
+    """
+    HTTP/1.1 server with keep-alive, routing exact paths to coroutines that
+    take a Request and return a Response.
+    """
+
+    def __init__(self, host: str, port: int):
+        self.host = host
+        self.port = port
+        self.routes = {}  # path -> (methods, handler)
+        self._server = None
+
+    def route(self, path: str, handler, methods=("GET",)):
+        self.routes[path] = (set(methods), handler)
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._serve, self.host, self.port)
+        # Port 0 asks the OS for a free port; report the one we got.
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _serve(self, reader, writer):
+        try:
+            while True:
+                try:
+                    request = await asyncio.wait_for(self._read_request(reader), READ_TIMEOUT)
+                except (
+                    asyncio.IncompleteReadError,
+                    asyncio.LimitOverrunError,
+                    asyncio.TimeoutError,
+                    ConnectionError,
+                ):
+                    return
+                if isinstance(request, Response):
+                    await self._write(writer, request, keep_alive=False)
+                    return
+                response = await self._dispatch(request)
+                keep_alive = request.headers.get("connection", "").lower() != "close"
+                await self._write(writer, response, keep_alive)
+                if not keep_alive:
+                    return
+        finally:
+            writer.close()
+
+    async def _read_request(self, reader):
+        head = await reader.readuntil(b"\r\n\r\n")
+        lines = head.decode("latin-1").split("\r\n")
+        try:
+            method, path, _ = lines[0].split(" ", 2)
+        except ValueError:
+            return Response(400)
+        headers = {}
+        for line in lines[1:]:
+            if ":" in line:
+                name, value = line.split(":", 1)
+                headers[name.strip().lower()] = value.strip()
+        try:
+            length = int(headers.get("content-length", "0"))
+        except ValueError:
+            return Response(400)
+        if length > MAX_BODY_SIZE:
+            return Response(413)
+        body = await reader.readexactly(length) if length else b""
+        return Request(method, path.split("?", 1)[0], headers, body)
+
+    async def _dispatch(self, request: Request) -> Response:
+        route = self.routes.get(request.path)
+        if route is None:
+            return Response(404)
+        methods, handler = route
+        if request.method not in methods:
+            return Response(405)
+        return await handler(request)
+
+    async def _write(self, writer, response: Response, keep_alive: bool):
+        head = (
+            f"HTTP/1.1 {response.status} {REASONS.get(response.status, '')}\r\n"
+            f"Content-Type: {response.content_type}\r\n"
+            f"Content-Length: {len(response.body)}\r\n"
+            f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n"
+        )
+        writer.write(head.encode("latin-1") + response.body)
+        await writer.drain()
+
+
+def telegram_webhook(app, secret_token: str):
+    """
+    Route handler feeding updates POSTed by Telegram into app.update_queue.
+    Without a secret token every request is refused: anyone who can reach the
+    port could otherwise act as any user.
+    """
+
+    async def handle(request: Request) -> Response:
+        received = request.headers.get("x-telegram-bot-api-secret-token", "")
+        if not secret_token or not hmac.compare_digest(received.encode(), secret_token.encode()):
+            return Response(403)
+        try:
+            update = Update.de_json(json.loads(request.body), app.bot)
+        except (ValueError, TypeError, KeyError):
+            return Response(400)
+        await app.update_queue.put(update)
+        return Response(200)
+
+    return handle
+
+
+async def health(request: Request) -> Response:
+    return Response(200, b"ok")